@@ -0,0 +1,211 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from typing import Optional, Tuple
+
+from config import get_settings, lazy
+from metrics import Counter, Gauge, Histogram, registry
+
+# --- Admission control for DeepSeek calls: bounded concurrency and queue ---
+
+class OverloadedError(Exception):
+    """
+    Raised instead of queueing when the wait queue is full or the wait
+    would exceed the queue timeout. `retry_after` is a hint in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _FileSlots:
+    """
+    Cross-worker slots: `limit` lock files in a shared directory, each held
+    with a non-blocking flock by at most one process at a time. Locks die
+    with their process, so a crashed worker never leaks a slot.
+    """
+
+    def __init__(self, directory: str, limit: int):
+        import fcntl
+        self._fcntl = fcntl
+        os.makedirs(directory, exist_ok=True)
+        self._paths = [os.path.join(directory, f"slot-{i}.lock") for i in range(limit)]
+        self._lock = threading.Lock()
+        self._held = set()   # slots held by this process
+
+    def try_acquire(self) -> Optional[Tuple[int, int]]:
+        """
+        (fd, slot index) of a free slot, or None if all are taken.
+        """
+        for i, path in enumerate(self._paths):
+            with self._lock:
+                if i in self._held:
+                    continue
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    self._fcntl.flock(fd, self._fcntl.LOCK_EX | self._fcntl.LOCK_NB)
+                except OSError:
+                    os.close(fd)
+                    continue
+                self._held.add(i)
+                return fd, i
+        return None
+
+    def release(self, token: Tuple[int, int]) -> None:
+        fd, i = token
+        with self._lock:
+            self._fcntl.flock(fd, self._fcntl.LOCK_UN)
+            os.close(fd)
+            self._held.discard(i)
+
+
+class Slot:
+    """
+    A granted admission; release() is idempotent so both a streaming
+    generator and its response cleanup can call it.
+    """
+
+    def __init__(self, limiter: "AdmissionLimiter", token: Optional[Tuple[int, int]], queue_time: float):
+        self.queue_time = queue_time
+        self._limiter = limiter
+        self._token = token
+        self._start = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._limiter._release(self._token, time.monotonic() - self._start)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class AdmissionLimiter:
+    """
+    At most `limit` calls in flight (across workers when `lock_dir` is
+    set), at most `max_queue` callers waiting, and no caller waits longer
+    than `queue_timeout`; otherwise OverloadedError is raised right away.
+    A limit of 0 admits everything.
+    """
+
+    @classmethod
+    def from_settings(cls, settings=None) -> "AdmissionLimiter":
+        settings = settings or get_settings()
+        lock_dir = settings.llm_lock_dir
+        if not lock_dir and settings.state_backend == "sqlite":
+            lock_dir = os.path.join(settings.data_dir, "llm_slots")
+        return cls(settings.llm_max_concurrency, settings.llm_max_queue,
+                   settings.llm_queue_timeout, lock_dir)
+
+    def __init__(self, limit: int, max_queue: int, queue_timeout: float, lock_dir: str = ""):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._files = _FileSlots(lock_dir, limit) if lock_dir and limit > 0 else None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        self._avg_hold = 1.0   # EWMA of slot hold time, for Retry-After
+
+    def _retry_after(self) -> int:
+        per_slot = max(1, self.limit)
+        return max(1, math.ceil(self._avg_hold * (self.waiting + 1) / per_slot))
+
+    def _reject(self, reason: str) -> OverloadedError:
+        self.rejected += 1
+        LLM_ADMISSIONS.inc(result="rejected")
+        return OverloadedError(reason, self._retry_after())
+
+    async def acquire(self) -> Slot:
+        if self.limit <= 0:
+            LLM_ADMISSIONS.inc(result="admitted")
+            self.admitted += 1
+            self.in_flight += 1
+            return Slot(self, None, 0.0)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        if not self._semaphore.locked():
+            # Free slot: acquire() returns without suspending
+            await self._semaphore.acquire()
+        elif self.waiting >= self.max_queue:
+            raise self._reject("DeepSeek queue is full")
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject("Timed out waiting for a DeepSeek slot")
+            finally:
+                self.waiting -= 1
+
+        token = None
+        if self._files is not None:
+            # Other workers may hold the shared slots: poll until the deadline
+            self.waiting += 1
+            try:
+                while (token := self._files.try_acquire()) is None:
+                    if time.monotonic() >= deadline:
+                        raise self._reject("Timed out waiting for a DeepSeek slot")
+                    await asyncio.sleep(0.02)
+            except BaseException:
+                # Timed out or cancelled: hand back the in-process slot
+                self._semaphore.release()
+                raise
+            finally:
+                self.waiting -= 1
+
+        waited = time.monotonic() - start
+        LLM_ADMISSIONS.inc(result="admitted")
+        LLM_QUEUE_SECONDS.observe(waited)
+        self.admitted += 1
+        self.in_flight += 1
+        self.queue_time_total += waited
+        self.queue_time_max = max(self.queue_time_max, waited)
+        return Slot(self, token, waited)
+
+    def _release(self, token: Optional[Tuple[int, int]], held: float) -> None:
+        self.in_flight -= 1
+        self._avg_hold = 0.8 * self._avg_hold + 0.2 * held
+        if self.limit <= 0:
+            return
+        if token is not None:
+            self._files.release(token)
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_time_avg": self.queue_time_total / self.admitted if self.admitted else 0.0,
+            "queue_time_max": self.queue_time_max,
+            "cross_worker": self._files is not None,
+        }
+
+
+get_llm_limiter = lazy(AdmissionLimiter.from_settings)
+
+LLM_ADMISSIONS = registry.register(Counter(
+    "llm_admissions_total", "DeepSeek admission decisions (admitted, rejected)", ("result",)
+))
+LLM_QUEUE_SECONDS = registry.register(Histogram(
+    "llm_queue_seconds", "Time spent waiting for a DeepSeek slot"
+))
+registry.register(Gauge("llm_in_flight", "DeepSeek calls in flight", lambda: get_llm_limiter().in_flight))
+registry.register(Gauge("llm_waiting", "Requests waiting for a DeepSeek slot", lambda: get_llm_limiter().waiting))
@@ -1,32 +1,40 @@
+import asyncio
+import json
 import random
-import requests
-import re
-import os
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-
-from config import URL_DEEPSEEK, HEADERS
-from data import load_captions
+import httpx
+import time
+from typing import List, Optional
+from fastapi import Depends, FastAPI, Header, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from starlette.background import BackgroundTask
+
+from admission import OverloadedError, get_llm_limiter
+from cache import MISS, ReadyPool, SharedReadyPool
+from config import Settings, get_settings, lazy
+from data import US_CITIES, get_corpus
+from dedupe import get_caption_index
+from deepseek import (
+    build_payload, complete_async, complete_many_async, get_response_cache, response_key, stream_async
+)
+from context import LocationContext
 from generator import (
-    generate_baity_prompt,
-    generate_opinion_prompt,
-    generate_event_prompt_with_location
+    generate_baity_prompt_async,
+    generate_opinion_prompt_async,
+    generate_event_prompt_with_location_async
 )
+from http_client import close_async_client
+from metrics import CAPTIONS, DUPLICATES, REQUEST_SECONDS, observe_stage, registry, stage
+from postprocess import StreamCleaner, clean_batch, clean_caption
+from prefetch import Prefetcher
+from sampler import draw_async
+from shared import get_store, shared_enabled
+from templates import TEMPLATES
+import tracing
+from upstream import CircuitOpenError
 
-def load_openers(filename: str, default: list[str]) -> list[str]:
-    """
-    Load one-per-line openers from data/<filename>; fall back to default list.
-    """
-    path = os.path.join(os.path.dirname(__file__), 'data', filename)
-    try:
-        with open(path, 'r', encoding='utf-8') as f:
-            lines = [line.strip() for line in f if line.strip()]
-            return lines or default
-    except Exception:
-        return default
-
-# ——— Load custom opener lists ———
-girlfriend_openers = load_openers('girlfriend_openers.txt', [
+# ——— Fallback opener lists (used when data/<name>.txt is missing or empty) ———
+DEFAULT_GIRLFRIEND_OPENERS = [
     # you should populate data/girlfriend_openers.txt with 50+ entries
     "Omg, did you hear",
     "Can't believe",
@@ -38,9 +46,9 @@ girlfriend_openers = load_openers('girlfriend_openers.txt', [
     "Okay, real talk",
     "Just read",
     "PSA:"
-])
+]
 
-baity_openers = load_openers('baity_openers.txt', [
+DEFAULT_BAITY_OPENERS = [
     "Guess what",
     "Feeling spicy",
     "Hot tip",
@@ -51,16 +59,67 @@ baity_openers = load_openers('baity_openers.txt', [
     "Not to brag",
     "FYI",
     "Psst"
-])
+]
 
-# ——— Load caption templates and references ———
-captions_baity, captions_opinion = load_captions()
-baity_references = load_openers('baity_references.txt', captions_baity)
+# ——— Load caption corpus once at import (hot-reloads on file changes) ———
+get_corpus()
 
 app = FastAPI(title="Caption Generator API")
 
-# Keep track of which base prompts we've used
-used_baity, used_opinion, used_events = set(), set(), set()
+STYLE_TYPES = {1: "baity", 2: "opinion", 3: "event"}
+
+def _make_ready_pool() -> ReadyPool:
+    """
+    Extra captions from n>1 DeepSeek calls, keyed by (style, location, persona).
+    """
+    settings = get_settings()
+    if shared_enabled():
+        return SharedReadyPool(get_store(), settings.ready_pool_ttl, settings.ready_pool_per_key)
+    return ReadyPool(settings.ready_pool_ttl, settings.ready_pool_per_key, settings.ready_pool_max_keys)
+
+def _make_prefetcher() -> Prefetcher:
+    """
+    Keeps weather/news/event context warm for hot locations.
+    """
+    settings = get_settings()
+    return Prefetcher(
+        settings.prefetch_locations or US_CITIES,
+        interval=settings.prefetch_interval,
+        top_n=settings.prefetch_top_n,
+        concurrency=settings.prefetch_concurrency,
+        event_cities=US_CITIES
+    )
+
+get_ready_pool = lazy(_make_ready_pool)
+get_prefetcher = lazy(_make_prefetcher)
+
+@app.on_event("startup")
+async def startup():
+    # Loading a large duplicate index takes seconds; do it before traffic
+    await asyncio.to_thread(get_caption_index().load)
+    if shared_enabled():
+        await asyncio.to_thread(get_store().purge_expired)
+    if get_settings().prefetch_enabled:
+        get_prefetcher().start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await get_prefetcher().stop()
+    await asyncio.to_thread(get_caption_index().flush)
+    # Drop pooled keep-alive connections cleanly
+    await close_async_client()
+
+def _no_repeat_key(loc: str, bio: str):
+    """
+    Scope for no-repeat sampling: one shuffle bag per corpus, or per
+    location / persona when NO_REPEAT_SCOPE asks for it.
+    """
+    scope = get_settings().no_repeat_scope
+    if scope == "location":
+        return loc.lower()
+    if scope == "persona":
+        return bio.lower()
+    return None
 
 class CaptionRequest(BaseModel):
     location: str
@@ -69,29 +128,84 @@ class CaptionRequest(BaseModel):
 class CaptionResponse(BaseModel):
     caption: str
     caption_type: str
+    trace: Optional[dict] = None   # only when tracing was requested
+
+class BatchRequest(BaseModel):
+    items: List[CaptionRequest] = Field(default_factory=list)
+    request: Optional[CaptionRequest] = None   # repeated `count` times
+    count: int = Field(1, ge=1)
+    concurrency: Optional[int] = Field(None, ge=1)
+
+class BatchItem(BaseModel):
+    index: int
+    caption: Optional[str] = None
+    caption_type: Optional[str] = None
+    error: Optional[str] = None
+
+class BatchResponse(BaseModel):
+    results: List[BatchItem]
 
 @app.get("/")
 def root():
     return {"message": "Caption Generator API is running."}
 
-@app.post("/generate", response_model=CaptionResponse)
-def generate_caption(request: CaptionRequest):
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Prometheus text exposition of this worker's counters and histograms.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/settings")
+def effective_settings(settings: Settings = Depends(get_settings)):
+    """
+    The settings this worker runs with, API keys masked.
+    """
+    return settings.as_dict()
+
+@app.get("/admission")
+def admission_stats():
+    """
+    DeepSeek admission counters: in flight, queued, shed, queue times.
+    """
+    return get_llm_limiter().stats()
+
+@app.get("/templates")
+def template_report():
+    """
+    Prompt templates skipped as invalid, and valid ones not yet used.
+    """
+    return TEMPLATES.report()
+
+def _validate(request: CaptionRequest):
     loc = request.location.strip()
     bio = request.description.strip()
     if not loc or not bio:
         raise HTTPException(status_code=400, detail="Both location and description are required")
+    return loc, bio
 
+def _pick_style() -> int:
     # Randomly pick style: 1=baity,2=opinion,3=event
-    style = random.choice([1, 2, 3])
+    return random.choice([1, 2, 3])
+
+async def _build_prompt(ctx: LocationContext, bio: str, style: int):
+    """
+    Build the (system, user, caption_type) messages for a style from the
+    location's context snapshot.
+    """
+    corpus = get_corpus()
+    captions_baity, captions_opinion = corpus.baity, corpus.opinion
+    girlfriend_openers = corpus.girlfriend_openers or DEFAULT_GIRLFRIEND_OPENERS
+
+    scope = _no_repeat_key(ctx.location, bio)
 
     if style == 1:
         # — Baity —
-        subset = random.sample(captions_baity, min(len(captions_baity), max(5, len(captions_baity)//3)))
-        base = random.choice([b for b in subset if b not in used_baity] or subset)
-        used_baity.add(base)
+        with stage("sample"):
+            base = await draw_async("baity", captions_baity, scope)
 
-        dynamic = generate_baity_prompt(loc, bio)
-        reference = random.choice(baity_references)
+        dynamic = await generate_baity_prompt_async(ctx, bio)
+        reference = random.choice(corpus.baity_references)
         system = (
             f"You are posting as “{bio}”. "
             f"Here’s a style example: {reference}. "
@@ -102,11 +216,10 @@ def generate_caption(request: CaptionRequest):
 
     elif style == 2:
         # — Opinion —
-        subset = random.sample(captions_opinion, min(len(captions_opinion), max(5, len(captions_opinion)//3)))
-        base = random.choice([b for b in subset if b not in used_opinion] or subset)
-        used_opinion.add(base)
+        with stage("sample"):
+            base = await draw_async("opinion", captions_opinion, scope)
 
-        dynamic = generate_opinion_prompt(base, loc)
+        dynamic = await generate_opinion_prompt_async(base, ctx)
         opener = random.choice(girlfriend_openers)
         system = (
             f"You are a witty girlfriend (“{bio}”) sharing a hot take. "
@@ -117,11 +230,10 @@ def generate_caption(request: CaptionRequest):
 
     else:
         # — Event —
-        subset = random.sample(captions_opinion, min(len(captions_opinion), max(5, len(captions_opinion)//3)))
-        base = random.choice([b for b in subset if b not in used_events] or subset)
-        used_events.add(base)
+        with stage("sample"):
+            base = await draw_async("events", captions_opinion, scope)
 
-        dynamic = generate_event_prompt_with_location(base, loc)
+        dynamic = await generate_event_prompt_with_location_async(base, ctx)
         system = (
             f"You are a flirty gal (“{bio}”) telling friends about a real event. "
             "Name the event, city & when (e.g. today/tomorrow), in a smooth 2‑line post with one emoji—no ad tone."
@@ -129,35 +241,289 @@ def generate_caption(request: CaptionRequest):
         user_msg = dynamic
         caption_type = "event"
 
-    # — Call DeepSeek —
-    payload = {
-        "model": "deepseek-chat",
-        "messages": [
-            {"role": "system", "content": system},
-            {"role": "user",   "content": user_msg}
-        ],
-        "n": 1,
-        "max_tokens": 60,
-        "temperature": random.uniform(0.7, 0.85),
-        "top_p": 0.9
-    }
+    return system, user_msg, caption_type
 
-    try:
-        resp = requests.post(URL_DEEPSEEK, json=payload, headers=HEADERS)
-        resp.raise_for_status()
-        text = resp.json()["choices"][0]["message"]["content"].strip()
+def _overloaded(e: OverloadedError, settings: Settings) -> HTTPException:
+    return HTTPException(
+        status_code=settings.llm_overload_status,
+        detail=str(e),
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-        # — Cleanup final output —
-        text = re.sub(r"\([^)]*\)", "", text)       # strip any parentheses+content
-        for q in ['"', "“", "”"]:
-            text = text.replace(q, "")
-        text = re.sub(r"\s{2,}", " ", text).strip()
+async def _pop_fresh(pool_key):
+    """
+    Next pooled caption that is not a near-duplicate of one served since
+    it was pooled, or MISS.
+    """
+    while (ready := await get_ready_pool().pop_async(pool_key)) is not MISS:
+        if await get_caption_index().check_and_add_async(ready):
+            return ready
+        DUPLICATES.inc(origin="pool")
+    return MISS
+
+async def _cached_fresh(cache_key):
+    """
+    Cached completion for the prompt, or MISS. Its own earlier servings
+    are what the cache rotates through and do not count; one that is a
+    near-duplicate of a different caption served since is dropped from
+    the cache so a fresh completion can take its place.
+    """
+    cached = await get_response_cache().get_async(cache_key)
+    if cached is MISS or await get_caption_index().check_and_add_async(cached, repeat_ok=True):
+        return cached
+    await get_response_cache().discard_async(cache_key, cached)
+    DUPLICATES.inc(origin="cache")
+    return MISS
 
-        # keep first two non‑empty lines only
-        lines = [ln for ln in text.splitlines() if ln.strip()]
-        text = "\n".join(lines[:2])
+async def _fallback(ctx: LocationContext, bio: str, style: int, user_msg: str,
+                    settings: Settings) -> str:
+    """
+    Caption served while DeepSeek's circuit is open: the cleaned template
+    prompt. A near-duplicate gets the prompt rebuilt (fresh base caption
+    and template draws) up to DEDUPE_RETRIES times.
+    """
+    retries = max(0, settings.dedupe_retries)
+    for attempt in range(1 + retries):
+        caption = clean_caption(user_msg)
+        if await get_caption_index().check_and_add_async(caption):
+            return caption
+        DUPLICATES.inc(origin="fallback")
+        if attempt < retries:
+            _, user_msg, _ = await _build_prompt(ctx, bio, style)
+    # Out of retries: serve the repeat rather than fail
+    await get_caption_index().add_async(caption)
+    return caption
+
+async def _generate(request: CaptionRequest, settings: Settings,
+                    context: Optional[LocationContext] = None) -> CaptionResponse:
+    """
+    One caption. A batch passes the shared context for the location.
+    """
+    loc, bio = _validate(request)
+    get_prefetcher().record(loc)
+    style = _pick_style()
 
-        return CaptionResponse(caption=text, caption_type=caption_type)
+    # — Serve a caption harvested by an earlier n>1 call, if any —
+    pool_key = (style, loc.lower(), bio.lower())
+    if settings.llm_choices > 1:
+        ready = await _pop_fresh(pool_key)
+        if ready is not MISS:
+            CAPTIONS.inc(caption_type=STYLE_TYPES[style], origin="pool")
+            tracing.note(style=STYLE_TYPES[style], origin="pool")
+            return CaptionResponse(caption=ready, caption_type=STYLE_TYPES[style])
 
-    except requests.exceptions.RequestException as e:
+    tracing.note(style=STYLE_TYPES[style])
+    ctx = context or LocationContext(loc)
+    system, user_msg, caption_type = await _build_prompt(ctx, bio, style)
+
+    # — Call DeepSeek (admission-controlled) unless the prompt is cached —
+    payload = build_payload(system, user_msg)
+    cache_key = response_key(payload)
+    cached = await _cached_fresh(cache_key)
+    if cached is not MISS:
+        CAPTIONS.inc(caption_type=caption_type, origin="cache")
+        tracing.note(origin="cache")
+        return CaptionResponse(caption=cached, caption_type=caption_type)
+
+    try:
+        async with await get_llm_limiter().acquire() as slot:
+            tracing.note(queue_ms=round(slot.queue_time * 1000, 2))
+            # Regenerate when every choice repeats an earlier caption
+            for attempt in range(1 + max(0, settings.dedupe_retries)):
+                with stage("deepseek"):
+                    if settings.llm_choices > 1:
+                        payload["n"] = settings.llm_choices
+                        texts = await complete_many_async(payload)
+                    else:
+                        texts = [await complete_async(payload)]
+                with stage("cleanup"):
+                    captions = clean_batch(texts)
+                with stage("dedupe"):
+                    fresh = [c for c in captions if not await get_caption_index().is_duplicate_async(c)]
+                DUPLICATES.inc(len(captions) - len(fresh), origin="llm")
+                if fresh or not captions:
+                    break
+
+    except OverloadedError as e:
+        raise _overloaded(e, settings)
+
+    except CircuitOpenError:
+        # DeepSeek is marked down: fast-fail to the template-built prompt
+        CAPTIONS.inc(caption_type=caption_type, origin="fallback")
+        tracing.note(origin="fallback")
+        caption = await _fallback(ctx, bio, style, user_msg, settings)
+        return CaptionResponse(caption=caption, caption_type=caption_type)
+
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"API Error: {e}")
+
+    # Out of retries: serve the repeat rather than fail
+    captions = fresh or captions
+    # Only the served caption is cached; extras go to the pool alone, so
+    # no caption can come back from both
+    await get_response_cache().add_async(cache_key, captions[:1])
+    if settings.llm_choices > 1 and captions:
+        await get_ready_pool().put_many_async(pool_key, captions[1:])
+    if captions:
+        await get_caption_index().add_async(captions[0])
+    CAPTIONS.inc(caption_type=caption_type, origin="llm")
+    tracing.note(origin="llm", dedupe_retries=attempt)
+    return CaptionResponse(caption=captions[0] if captions else "", caption_type=caption_type)
+
+async def _generate_profiled(request: CaptionRequest, settings: Settings) -> CaptionResponse:
+    with tracing.Profile(settings.profile_dir, settings.profile_max_files) as prof:
+        res = await _generate(request, settings)
+    tracing.note(profile=prof.path)
+    return res
+
+async def _generate_traced(request: CaptionRequest, settings: Settings, profiled: bool) -> CaptionResponse:
+    with tracing.capture() as trace:
+        res = await (_generate_profiled if profiled else _generate)(request, settings)
+        res.trace = trace.to_dict()
+    return res
+
+@app.post("/generate", response_model=CaptionResponse, response_model_exclude_none=True)
+async def generate_caption(request: CaptionRequest, trace: bool = False, profile: bool = False,
+                           x_trace: Optional[str] = Header(None),
+                           settings: Settings = Depends(get_settings)):
+    """
+    `?trace=1` (or an `X-Trace: 1` header) adds a timing breakdown to the
+    response. With PROFILE_ENABLED, `?profile=1` on a traced request (or
+    the PROFILE_SAMPLE_RATE share of any request) also saves a cProfile file.
+    """
+    traced = settings.trace_enabled and (trace or x_trace not in (None, "", "0"))
+    profiled = settings.profile_enabled and (
+        (traced and profile) or random.random() < settings.profile_sample_rate)
+    with REQUEST_SECONDS.time(endpoint="generate"):
+        if traced:
+            return await _generate_traced(request, settings, profiled)
+        if profiled:
+            return await _generate_profiled(request, settings)
+        return await _generate(request, settings)
+
+@app.post("/generate/stream")
+async def generate_caption_stream(request: CaptionRequest, settings: Settings = Depends(get_settings)):
+    """
+    Server-Sent Events version of /generate. Emits a `meta` event with the
+    caption type, `token` events with cleaned text deltas as DeepSeek
+    streams them, then `done` with the full caption (or `error`).
+    """
+    started = time.perf_counter()
+    loc, bio = _validate(request)
+    get_prefetcher().record(loc)
+    ctx, style = LocationContext(loc), _pick_style()
+    system, user_msg, caption_type = await _build_prompt(ctx, bio, style)
+    payload = build_payload(system, user_msg)
+    cache_key = response_key(payload)
+    cached = await _cached_fresh(cache_key)
+    if cached is not MISS:
+        async def replay():
+            yield _sse("meta", {"caption_type": caption_type})
+            yield _sse("token", {"text": cached})
+            CAPTIONS.inc(caption_type=caption_type, origin="cache")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="stream")
+            yield _sse("done", {"caption": cached, "caption_type": caption_type})
+        return StreamingResponse(
+            replay(), media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    # Admit before responding so an overload is a real 503/429, not an SSE error
+    try:
+        slot = await get_llm_limiter().acquire()
+    except OverloadedError as e:
+        raise _overloaded(e, settings)
+
+    async def events():
+        yield _sse("meta", {"caption_type": caption_type})
+        cleaner = StreamCleaner()
+        parts = []
+        llm_started = time.perf_counter()
+        try:
+            async for delta in stream_async(payload):
+                text = cleaner.feed(delta)
+                if text:
+                    parts.append(text)
+                    yield _sse("token", {"text": text})
+                if cleaner.done:
+                    break
+        except CircuitOpenError:
+            text = await _fallback(ctx, bio, style, user_msg, settings)
+            CAPTIONS.inc(caption_type=caption_type, origin="fallback")
+            yield _sse("token", {"text": text})
+            yield _sse("done", {"caption": text, "caption_type": caption_type})
+            return
+        except httpx.HTTPError as e:
+            yield _sse("error", {"detail": f"API Error: {e}"})
+            return
+        finally:
+            slot.release()
+            observe_stage("deepseek", time.perf_counter() - llm_started)
+        text = cleaner.finish()
+        if text:
+            parts.append(text)
+            yield _sse("token", {"text": text})
+        caption = "".join(parts)
+        await get_response_cache().add_async(cache_key, [caption])
+        # Already streamed, so a repeat cannot be regenerated; just record it
+        await get_caption_index().add_async(caption)
+        CAPTIONS.inc(caption_type=caption_type, origin="llm")
+        REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint="stream")
+        yield _sse("done", {"caption": caption, "caption_type": caption_type})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        # Also frees the slot if the client disconnects before streaming starts
+        background=BackgroundTask(slot.release)
+    )
+
+@app.post("/generate/batch", response_model=BatchResponse)
+async def generate_batch(batch: BatchRequest, settings: Settings = Depends(get_settings)):
+    """
+    Generate many captions in one call. Context (weather/news/events) is
+    fetched once per unique location up front into a snapshot every item
+    for that location shares; DeepSeek calls then run
+    concurrently up to the concurrency limit. Results keep request order.
+    """
+    with REQUEST_SECONDS.time(endpoint="batch"):
+        return await _generate_batch(batch, settings)
+
+async def _generate_batch(batch: BatchRequest, settings: Settings) -> BatchResponse:
+    items = list(batch.items)
+    if batch.request is not None:
+        items += [batch.request] * batch.count
+    if not items:
+        raise HTTPException(status_code=400, detail="Provide items or a request with a count")
+    if len(items) > settings.batch_max_items:
+        raise HTTPException(status_code=400, detail=f"At most {settings.batch_max_items} captions per batch")
+
+    # One snapshot per unique location, shared by every item for it
+    contexts = {}
+    item_contexts = []
+    for item in items:
+        ctx = LocationContext(item.location)
+        item_contexts.append(contexts.setdefault(ctx.key, ctx) if ctx.key else None)
+    await asyncio.gather(*(ctx.prefetch_async() for ctx in contexts.values()))
+
+    limit = max(1, min(batch.concurrency or settings.batch_concurrency, settings.batch_concurrency))
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(index: int, item: CaptionRequest, ctx: Optional[LocationContext]) -> BatchItem:
+        async with semaphore:
+            try:
+                res = await _generate(item, settings, ctx)
+                return BatchItem(index=index, caption=res.caption, caption_type=res.caption_type)
+            except HTTPException as e:
+                return BatchItem(index=index, error=str(e.detail))
+            except Exception as e:
+                return BatchItem(index=index, error=f"Unexpected error: {e}")
+
+    results = await asyncio.gather(
+        *(run(i, item, ctx) for i, (item, ctx) in enumerate(zip(items, item_contexts)))
+    )
+    return BatchResponse(results=results)
@@ -0,0 +1,644 @@
+# bench.py
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# Offline benchmark: fake DeepSeek / WeatherAPI / Google News / Nominatim /
+# PredictHQ servers on localhost, then drive /generate or main.py against them.
+# Repo modules are imported only after the environment points them at the fakes.
+
+BENCH_LOCATIONS = [
+    "New York", "Los Angeles", "Chicago", "Houston", "Phoenix", "Austin", "Miami", "Seattle",
+    "Denver", "Boston", "Portland, Maine", "Bozeman", "Asheville", "Key West", "Sedona"
+]
+
+# Simulated upstream latency in seconds: (mean, jitter)
+DEFAULT_LATENCY = {
+    "deepseek": (0.8, 0.3),
+    "weather": (0.15, 0.05),
+    "news": (0.25, 0.1),
+    "nominatim": (0.3, 0.1),
+    "predicthq": (0.3, 0.1),
+}
+
+# How long an injected timeout holds the request before dropping the
+# connection; longer than any client timeout the app uses
+HANG_SECONDS = 60
+
+CAPTION_WORDS = "sunny vibes brunch rooftop jazz tacos rain skyline weekend festival coffee sunset".split()
+
+
+class FakeUpstream:
+    """
+    One threaded HTTP server answering all five providers by path prefix,
+    counting calls per service. `errors` maps a service to (rate, status):
+    that share of its calls fail with the HTTP status, or hang and drop the
+    connection when status is "timeout". Injected failures are counted by
+    "service status".
+    """
+
+    def __init__(self, latency: Dict[str, tuple], errors: Optional[Dict[str, tuple]] = None):
+        self.latency = latency
+        self.errors = errors or {}
+        self.calls: Counter = Counter()
+        self.injected: Counter = Counter()
+        self._lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.handle(self)
+
+            def do_POST(self):
+                fake.handle(self)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+
+    def env(self) -> Dict[str, str]:
+        return {
+            "URL_DEEPSEEK": f"{self.base}/deepseek/chat/completions",
+            "URL_WEATHER": f"{self.base}/weather/current.json",
+            "URL_NEWS_RSS": f"{self.base}/news/rss/search",
+            "URL_NOMINATIM": f"{self.base}/nominatim/search",
+            "URL_PREDICTHQ": f"{self.base}/predicthq/v1/events/",
+        }
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.injected.clear()
+
+    def handle(self, req: BaseHTTPRequestHandler) -> None:
+        url = urlparse(req.path)
+        service = url.path.strip("/").split("/")[0]
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = req.rfile.read(int(req.headers.get("Content-Length") or 0))
+        with self._lock:
+            self.calls[service] += 1
+
+        mean, jitter = self.latency.get(service, (0, 0))
+        time.sleep(max(0.0, random.uniform(mean - jitter, mean + jitter)))
+
+        rate, status = self.errors.get(service, (0.0, None))
+        if rate and random.random() < rate:
+            with self._lock:
+                self.injected[f"{service} {status}"] += 1
+            if status == "timeout":
+                time.sleep(HANG_SECONDS)
+                req.close_connection = True
+                return
+            req.send_response(status)
+            req.send_header("Content-Length", "0")
+            req.end_headers()
+            return
+
+        if service == "deepseek":
+            payload = json.loads(body or b"{}")
+            if payload.get("stream"):
+                data, ctype = self._deepseek_stream(), "text/event-stream"
+            else:
+                data, ctype = self._deepseek(payload), "application/json"
+        elif service == "weather":
+            data, ctype = self._weather(query.get("q", "")), "application/json"
+        elif service == "news":
+            data, ctype = self._news(query.get("q", "")), "application/rss+xml"
+        elif service == "nominatim":
+            data, ctype = json.dumps([{"lat": "40.0", "lon": "-100.0"}]).encode(), "application/json"
+        elif service == "predicthq":
+            data, ctype = self._predicthq(int(query.get("offset", 0))), "application/json"
+        else:
+            req.send_response(404)
+            req.send_header("Content-Length", "0")
+            req.end_headers()
+            return
+        req.send_response(200)
+        req.send_header("Content-Type", ctype)
+        req.send_header("Content-Length", str(len(data)))
+        req.end_headers()
+        req.wfile.write(data)
+
+    @staticmethod
+    def _deepseek(payload: dict) -> bytes:
+        choices = [
+            {"index": i, "message": {"role": "assistant",
+                                     "content": " ".join(random.sample(CAPTION_WORDS, 6)) + " ✨"}}
+            for i in range(int(payload.get("n", 1)))
+        ]
+        return json.dumps({
+            "choices": choices,
+            "usage": {"prompt_tokens": 120, "completion_tokens": 18 * len(choices)}
+        }).encode()
+
+    @staticmethod
+    def _deepseek_stream() -> bytes:
+        # One SSE `data:` chunk per word, like DeepSeek's stream=True responses
+        words = random.sample(CAPTION_WORDS, 6) + ["✨"]
+        chunks = [
+            {"choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}}]}
+            for i, word in enumerate(words)
+        ]
+        chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                       "usage": {"prompt_tokens": 120, "completion_tokens": 18}})
+        events = [f"data: {json.dumps(chunk)}\n\n" for chunk in chunks] + ["data: [DONE]\n\n"]
+        return "".join(events).encode()
+
+    @staticmethod
+    def _weather(location: str) -> bytes:
+        return json.dumps({
+            "location": {"name": location.split(",")[0], "region": "Somewhere"},
+            "current": {"condition": {"text": random.choice(["Sunny", "Cloudy", "Rainy"])}}
+        }).encode()
+
+    @staticmethod
+    def _news(query: str) -> bytes:
+        city = query.replace(" news", "")
+        return (
+            '<?xml version="1.0"?><rss version="2.0"><channel><title>News</title>'
+            f'<item><title>{city} opens a new waterfront park</title></item>'
+            '</channel></rss>'
+        ).encode()
+
+    @staticmethod
+    def _predicthq(offset: int) -> bytes:
+        # One short page so each city ingest is a single request
+        if offset:
+            return json.dumps({"results": []}).encode()
+        today = date.today()
+        results = [
+            {"title": f"Bench Fest {i}", "category": "festivals",
+             "start": f"{(today + timedelta(days=i)).isoformat()}T19:00:00Z",
+             "venue": {"label": "Main Stage"}}
+            for i in range(3)
+        ]
+        return json.dumps({"results": results}).encode()
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99)}
+
+def report(title: str, latencies: List[float], failures: Counter, elapsed: float, calls: Counter,
+           injected: Counter) -> dict:
+    """
+    Print and return one run's results. `failures` counts failed captions
+    by cause as the client saw them; `injected` counts the upstream
+    errors the fake servers injected, by service and status.
+    """
+    done = len(latencies)
+    pct = percentiles(latencies)
+    total_calls = sum(calls.values())
+    result = {
+        "mode": title,
+        "captions": done,
+        "failures": sum(failures.values()),
+        "failures_by_cause": dict(failures),
+        "injected_errors": dict(injected),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_per_s": round(done / elapsed, 2) if elapsed else 0.0,
+        **{k: round(v * 1000, 1) for k, v in pct.items()},
+        "upstream_calls": dict(calls),
+        "upstream_calls_per_caption": round(total_calls / done, 2) if done else 0.0,
+    }
+    print(f"\n=== {title}: {done} captions, {result['failures']} failed, {elapsed:.2f}s ({result['throughput_per_s']}/s) ===")
+    print(f"latency ms  p50={result['p50']}  p95={result['p95']}  p99={result['p99']}")
+    print(f"upstream calls per caption: {result['upstream_calls_per_caption']}")
+    for service in sorted(calls):
+        print(f"  {service:<10} {calls[service]:>6}  ({calls[service] / max(1, done):.2f}/caption)")
+    if failures:
+        print("failures by cause:")
+        for cause, n in failures.most_common():
+            print(f"  {cause:<24} {n:>6}")
+    if injected:
+        print("injected upstream errors:")
+        for cause, n in injected.most_common():
+            print(f"  {cause:<24} {n:>6}")
+    return result
+
+# --- /generate against a uvicorn subprocess ---
+
+def _wait_ready(base_url: str, timeout: float = 30) -> None:
+    import httpx
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(base_url + "/").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API did not come up at {base_url}")
+
+async def _drive_api(base_url: str, count: int, concurrency: int, locations: List[str]):
+    import httpx
+    latencies, failures = [], Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        async def one():
+            body = {"location": random.choice(locations), "description": "24-year-old foodie who loves jazz"}
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    resp = await client.post("/generate", json=body)
+                except httpx.HTTPError as e:
+                    failures[type(e).__name__] += 1
+                    return
+                if resp.is_success:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures[f"HTTP {resp.status_code}"] += 1
+
+        await asyncio.gather(*(one() for _ in range(count)))
+    return latencies, failures
+
+def bench_api(fake: FakeUpstream, env: Dict[str, str], count: int, concurrency: int,
+              locations: List[str], workers: int, port: int) -> dict:
+    base_url = f"http://127.0.0.1:{port}"
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+    )
+    try:
+        _wait_ready(base_url)
+        fake.reset()
+        start = time.perf_counter()
+        latencies, failures = asyncio.run(_drive_api(base_url, count, concurrency, locations))
+        return report("api /generate", latencies, failures, time.perf_counter() - start,
+                      Counter(fake.calls), Counter(fake.injected))
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+# --- main.py's generation path, in process ---
+
+def bench_cli(fake: FakeUpstream, count: int, concurrency: int, locations: List[str]) -> dict:
+    from concurrent.futures import ThreadPoolExecutor
+    from data import load_captions
+    from main import generate_one
+
+    captions_baity, captions_opinion = load_captions()
+
+    def timed_one():
+        start = time.perf_counter()
+        _, text = generate_one(random.choice(locations), captions_baity, captions_opinion)
+        return time.perf_counter() - start, text
+
+    fake.reset()
+    start = time.perf_counter()
+    latencies, failures = [], Counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        for elapsed, text in pool.map(lambda _: timed_one(), range(count)):
+            if text is None:
+                # generate_one only says that it failed; the injected counts say why
+                failures["no caption"] += 1
+            else:
+                latencies.append(elapsed)
+    return report("cli main.py", latencies, failures, time.perf_counter() - start,
+                  Counter(fake.calls), Counter(fake.injected))
+
+def parse_latency(specs: Optional[List[str]]) -> Dict[str, tuple]:
+    """
+    "deepseek=0.5" or "deepseek=0.5:0.1" (mean:jitter seconds) overrides.
+    """
+    latency = dict(DEFAULT_LATENCY)
+    for spec in specs or []:
+        service, _, value = spec.partition("=")
+        mean, _, jitter = value.partition(":")
+        latency[service] = (float(mean), float(jitter or 0))
+    return latency
+
+def parse_errors(specs: Optional[List[str]]) -> Dict[str, tuple]:
+    """
+    "deepseek=0.1:503" (fail 10% with HTTP 503) or "weather=0.05:timeout"
+    (hang 5% until the client gives up). The status defaults to 503.
+    """
+    errors = {}
+    for spec in specs or []:
+        service, _, value = spec.partition("=")
+        rate, _, status = value.partition(":")
+        status = status or "503"
+        errors[service] = (float(rate), status if status == "timeout" else int(status))
+    return errors
+
+# --- Caption post-processing micro-benchmarks (no upstream needed) ---
+
+RAW_CAPTIONS = [
+    '"Rooftop brunch in Chicago hits different ☀️ (honestly) — who\'s in? 😉 #BrunchGoals #Weekend"',
+    "Sunny vibes and tacos 🌮 all day\n\nSecond line with the jazz 🎷 plan 💃\nThird line nobody asked for",
+    "“Just my two cents”: skyline at sunset beats any filter (trust me) 👩‍👩‍👧 #NoFilter",
+    "Coffee first, festival later.  Rain or shine, I'm going 🇺🇸 🎉",
+    "Plain caption with no extras at all, just words about the weekend",
+    "Jazz on the river tonight and I already know what I'm wearing 🎷 who's coming?",
+]
+
+def _legacy_clean(text: str) -> str:
+    # The cleanup api.py ran before postprocess.py, for comparison
+    import re
+    text = re.sub(r"\([^)]*\)", "", text)
+    for q in ['"', "“", "”"]:
+        text = text.replace(q, "")
+    text = re.sub(r"\s{2,}", " ", text).strip()
+    lines = [ln for ln in text.splitlines() if ln.strip()]
+    return "\n".join(lines[:2])
+
+def bench_postprocess(count: int) -> dict:
+    """
+    Per-caption cost of the old cleanup, clean_caption, clean_batch and
+    StreamCleaner fed 4-character chunks; also checks that the streamed
+    and whole-text results agree.
+    """
+    from postprocess import StreamCleaner, clean_batch, clean_caption
+
+    def streamed(text: str) -> str:
+        cleaner = StreamCleaner()
+        parts = []
+        for i in range(0, len(text), 4):
+            parts.append(cleaner.feed(text[i:i + 4]))
+            if cleaner.done:
+                break
+        parts.append(cleaner.finish())
+        return "".join(parts)
+
+    for text in RAW_CAPTIONS:
+        if streamed(text) != clean_caption(text):
+            raise AssertionError(f"stream and batch cleanup disagree on {text!r}")
+
+    rounds = max(1, count)
+    cases = {
+        "legacy": lambda: [_legacy_clean(t) for t in RAW_CAPTIONS],
+        "clean_caption": lambda: [clean_caption(t) for t in RAW_CAPTIONS],
+        "clean_batch": lambda: clean_batch(RAW_CAPTIONS),
+        "stream": lambda: [streamed(t) for t in RAW_CAPTIONS],
+    }
+    result = {"mode": "postprocess", "captions": rounds * len(RAW_CAPTIONS), "us_per_caption": {}}
+    print(f"\n=== postprocess: {result['captions']} captions per case ===")
+    for name, fn in cases.items():
+        # Best of five runs, so scheduler noise does not swamp a few microseconds
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                fn()
+            best = min(best, time.perf_counter() - start)
+        per = best / result["captions"] * 1e6
+        result["us_per_caption"][name] = round(per, 2)
+        print(f"  {name:<14} {per:8.2f} us/caption")
+    for text in RAW_CAPTIONS[:3]:
+        print(f"  {text!r}\n    -> {clean_caption(text)!r}")
+    return result
+
+# --- Response cache hits with the duplicate index on ---
+
+def bench_cache(count: int) -> dict:
+    """
+    Asks for one prompt `count` times through the API's cache lookup, in a
+    temporary DATA_DIR with the configured DEDUPE_THRESHOLD. Each miss
+    stores a fresh completion, as /generate does. Checks that every lookup
+    hits once the key holds LLM_CACHE_PER_KEY completions. Also checks
+    that a cached completion is dropped once a near-copy of it has been
+    served from elsewhere.
+    """
+    from config import Settings, configure
+    data_dir = tempfile.mkdtemp(prefix="caption-cache-")
+    os.environ["DATA_DIR"] = data_dir
+    configure(Settings.from_env())
+
+    from api import _cached_fresh
+    from cache import MISS
+    from dedupe import get_caption_index
+    from deepseek import build_payload, get_response_cache, response_key
+
+    index, cache = get_caption_index(), get_response_cache()
+    per_key = cache.per_key
+    key = response_key(build_payload("You are a bench.", "The same prompt every time"))
+    result = {"mode": "cache", "lookups": count, "threshold": index.threshold, "checks": {}}
+
+    async def serve(i: int):
+        cached = await _cached_fresh(key)
+        if cached is not MISS:
+            return cached, True
+        # Words unique to this completion, so completions never near-duplicate each other
+        text = " ".join(f"{word}{i}" for word in random.sample(CAPTION_WORDS, 6))
+        if index.check_and_add(text):
+            cache.add(key, [text])
+        return text, False
+
+    async def run():
+        hits = [hit for _, hit in [await serve(i) for i in range(count)]]
+        # Serve a near-copy of one cached completion some other way
+        victim = await _cached_fresh(key)
+        if victim is MISS:
+            return hits, victim, []
+        index.add(victim + " tonight")
+        after = [await _cached_fresh(key) for _ in range(per_key)]
+        return hits, victim, after
+
+    try:
+        hits, victim, after = asyncio.run(run())
+        index.flush()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    result["hits"] = sum(hits)
+    result["checks"]["hits"] = result["hits"] == count - per_key and all(hits[per_key:])
+    result["checks"]["repeat_dropped"] = victim is not MISS and victim not in after
+    print(f"\n=== response cache: {count} lookups of one prompt, DEDUPE_THRESHOLD={index.threshold:g} ===")
+    print(f"hits: {result['hits']} (the first {per_key} lookups fill the key)")
+    for name, ok in result["checks"].items():
+        print(f"  {name:<14} {'ok' if ok else 'FAILED'}")
+    return result
+
+# --- Shared state across worker processes (STATE_BACKEND=sqlite) ---
+
+def _shared_draws(path: str, corpus_size: int, draws: int) -> tuple:
+    from sampler import SharedBagRegistry
+    from shared import SQLiteStore
+    registry = SharedBagRegistry(SQLiteStore(path))
+    corpus = list(range(corpus_size))
+    start = time.perf_counter()
+    drawn = [registry.draw("bench", corpus) for _ in range(draws)]
+    return drawn, time.perf_counter() - start
+
+def _shared_tokens(path: str, rate: float, burst: int, takes: int) -> List[float]:
+    from shared import SQLiteStore
+    from upstream import SharedTokenBucket
+    bucket = SharedTokenBucket(SQLiteStore(path), "bench", rate, burst)
+    granted = []
+    for _ in range(takes):
+        delay = bucket.take()
+        time.sleep(delay)
+        granted.append(time.time())
+    return granted
+
+def _shared_pops(path: str) -> List[str]:
+    from cache import MISS, SharedReadyPool
+    from shared import SQLiteStore
+    pool = SharedReadyPool(SQLiteStore(path), ttl=60, per_key=10_000)
+    got = []
+    while (item := pool.pop(["bench"])) is not MISS:
+        got.append(item)
+    return got
+
+def bench_shared(workers: int, count: int) -> dict:
+    """
+    Runs the shared no-repeat bags, token bucket and ready pool from
+    `workers` processes against one SQLite store and checks that they
+    behave like one process: each corpus cycle draws every item once,
+    the combined rate stays under the limit, and no pooled item is
+    served twice.
+    """
+    import multiprocessing
+    workers = max(2, workers)
+    path = os.path.join(tempfile.mkdtemp(prefix="caption-shared-"), "shared_state.sqlite3")
+    ctx = multiprocessing.get_context("spawn")
+    result = {"mode": "shared", "workers": workers, "checks": {}}
+    try:
+        with ctx.Pool(workers) as procs:
+            # Two full cycles of the corpus, split across the workers
+            per = count // workers
+            corpus_size = per * workers // 2
+            runs = procs.starmap(_shared_draws, [(path, corpus_size, per)] * workers)
+            flat = sorted(i for drawn, _ in runs for i in drawn)
+            result["checks"]["no_repeat"] = flat == sorted(list(range(corpus_size)) * 2)
+            # Workers ran concurrently: each one's rate adds up
+            result["draws_per_s"] = round(sum(len(drawn) / secs for drawn, secs in runs), 1)
+
+            rate, burst, takes = 200.0, 10, 50
+            granted = sorted(t for chunk in procs.starmap(
+                _shared_tokens, [(path, rate, burst, takes)] * workers) for t in chunk)
+            # In any window of T seconds at most burst + rate * T grants
+            # (one token and 5 ms of slack for clocks and sleeps)
+            worst = max(
+                (j - i + 1) - (burst + rate * (granted[j] - granted[i] + 0.005))
+                for i in range(len(granted)) for j in range(i, len(granted))
+            )
+            result["token_span_s"] = round(granted[-1] - granted[0], 3)
+            result["checks"]["rate_limit"] = worst <= 1
+
+            from cache import SharedReadyPool
+            from shared import SQLiteStore
+            items = [f"caption {i}" for i in range(count)]
+            SharedReadyPool(SQLiteStore(path), ttl=60, per_key=10_000).put_many(["bench"], items)
+            popped = [i for chunk in procs.starmap(_shared_pops, [(path,)] * workers) for i in chunk]
+            result["checks"]["ready_pool"] = sorted(popped) == sorted(items)
+    finally:
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    print(f"\n=== shared state: {workers} processes ===")
+    print(f"bag draws: {result['draws_per_s']}/s across processes")
+    print(f"token bucket: {workers * takes} takes at {rate:g}/s (burst {burst}) "
+          f"spanned {result['token_span_s']}s")
+    for name, ok in result["checks"].items():
+        print(f"  {name:<12} {'ok' if ok else 'FAILED'}")
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark against fake upstream servers.")
+    parser.add_argument("mode", choices=["api", "cli", "both", "post", "shared", "cache"], nargs="?", default="both")
+    parser.add_argument("-n", "--count", type=int, default=200, help="captions per run (default: 200)")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="requests in flight (default: 16)")
+    parser.add_argument("-l", "--locations", nargs="+", default=BENCH_LOCATIONS)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="uvicorn workers for api mode")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", nargs="*", metavar="SERVICE=MEAN[:JITTER]",
+                        help="simulated upstream latency overrides, in seconds")
+    parser.add_argument("--errors", nargs="*", metavar="SERVICE=RATE[:STATUS|timeout]",
+                        help="inject upstream failures, e.g. deepseek=0.1:503 or weather=0.05:timeout")
+    parser.add_argument("--env", nargs="*", metavar="NAME=VALUE", default=[],
+                        help="extra settings for the code under test, e.g. LLM_CHOICES=3")
+    parser.add_argument("--json", metavar="PATH", help="also write the results as JSON")
+    parser.add_argument("--keep-data", action="store_true", help="keep the temporary DATA_DIR for inspection")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.mode in ("post", "shared", "cache"):
+        if args.mode == "post":
+            result = bench_postprocess(args.count)
+        elif args.mode == "cache":
+            result = bench_cache(args.count)
+        else:
+            result = bench_shared(args.workers, args.count)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump([result], f, indent=2)
+        return
+
+    fake = FakeUpstream(parse_latency(args.latency), parse_errors(args.errors))
+    fake.start()
+
+    # Fresh DATA_DIR per run (cold caches), with the bundled corpus copied in
+    data_dir = tempfile.mkdtemp(prefix="caption-bench-")
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+    for name in os.listdir(src):
+        path = os.path.join(src, name)
+        if os.path.isfile(path) and not name.endswith((".sqlite3", "-wal", "-shm")):
+            with open(path, "rb") as f_in, open(os.path.join(data_dir, name), "wb") as f_out:
+                f_out.write(f_in.read())
+
+    env = dict(os.environ)
+    env.update(fake.env())
+    env.update({
+        "DATA_DIR": data_dir,
+        "DEEPSEEK_API_KEY": env.get("DEEPSEEK_API_KEY") or "bench",
+        "WEATHER_API_KEY": env.get("WEATHER_API_KEY") or "bench",
+        "TICKETMASTER_API_KEY": env.get("TICKETMASTER_API_KEY") or "bench",
+        "PREFETCH_ENABLED": "false",
+    })
+    env.update(item.split("=", 1) for item in args.env)
+
+    results = []
+    try:
+        if args.mode in ("api", "both"):
+            results.append(bench_api(fake, env, args.count, args.concurrency,
+                                     args.locations, args.workers, args.port))
+        if args.mode in ("cli", "both"):
+            os.environ.update(env)
+            results.append(bench_cli(fake, args.count, args.concurrency, args.locations))
+    finally:
+        fake.stop()
+        if args.keep_data:
+            print(f"\nBench data dir: {data_dir}")
+        else:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
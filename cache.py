@@ -0,0 +1,486 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Returned by get() when a key is absent or expired
+MISS = object()
+
+
+class TTLCache:
+    """
+    Size-bounded LRU cache with a per-entry TTL. A ttl of None never expires.
+    Thread-safe; values are stored as-is.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, default: Any = MISS) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                expires, value = item
+                if expires is None or expires > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    # For callers on the event loop; SQLiteCache does its disk I/O in a thread
+    async def get_async(self, key: str, default: Any = MISS) -> Any:
+        return self.get(key, default)
+
+    async def set_async(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self.set(key, value, ttl)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache(TTLCache):
+    """
+    TTLCache backed by a SQLite file so entries survive restarts. The
+    in-memory LRU stays in front; SQLite is only read on a memory miss.
+    Values must be JSON-serializable (tuples come back as lists). Every
+    64 writes, expired rows and the oldest-written beyond max_rows
+    (default 4 * maxsize) are deleted, so the file stays bounded.
+    """
+
+    def __init__(self, path: str, maxsize: int = 1024, max_rows: Optional[int] = None):
+        super().__init__(maxsize)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_rows = max_rows or 4 * maxsize
+        self._writes = 0
+        self._db_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+        )
+        self._trim()
+        self._conn.commit()
+
+    def get(self, key: str, default: Any = MISS) -> Any:
+        value = super().get(key, MISS)
+        if value is not MISS:
+            return value
+        return self._load(key, default)
+
+    async def get_async(self, key: str, default: Any = MISS) -> Any:
+        # Memory hits stay on the loop; only a miss reads SQLite
+        value = super().get(key, MISS)
+        if value is not MISS:
+            return value
+        return await asyncio.to_thread(self._load, key, default)
+
+    async def set_async(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    def _load(self, key: str, default: Any) -> Any:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT expires, value FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return default
+        expires, raw = row
+        now = time.time()
+        if expires is not None and expires <= now:
+            self._delete_row(key)
+            return default
+        value = json.loads(raw)
+        # Promote into memory with whatever lifetime it has left
+        super().set(key, value, None if expires is None else expires - now)
+        # The memory miss above was really a hit
+        self.misses -= 1
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        super().set(key, value, ttl)
+        expires = None if ttl is None else time.time() + ttl
+        with self._db_lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)",
+                (key, expires, json.dumps(value))
+            )
+            self._writes += 1
+            if self._writes >= 64:
+                self._writes = 0
+                self._trim()
+            self._conn.commit()
+
+    def _trim(self) -> None:
+        # Expired rows, then the oldest written beyond max_rows (REPLACE gives a new rowid)
+        self._conn.execute(
+            "DELETE FROM cache WHERE expires IS NOT NULL AND expires <= ?", (time.time(),)
+        )
+        self._conn.execute(
+            "DELETE FROM cache WHERE rowid NOT IN "
+            "(SELECT rowid FROM cache ORDER BY rowid DESC LIMIT ?)", (self.max_rows,)
+        )
+
+    def _delete_row(self, key: str) -> None:
+        with self._db_lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+
+    def delete(self, key: str) -> None:
+        super().delete(key)
+        self._delete_row(key)
+
+    def clear(self) -> None:
+        super().clear()
+        with self._db_lock:
+            self._conn.execute("DELETE FROM cache")
+            self._conn.commit()
+
+    def purge_expired(self) -> None:
+        with self._db_lock:
+            self._trim()
+            self._conn.commit()
+
+
+class ReadyPool:
+    """
+    Pre-generated results waiting to be served, grouped by key. Each key
+    holds at most per_key items, each expiring after ttl seconds; the number
+    of keys is LRU-bounded.
+    """
+
+    def __init__(self, ttl: float = 900, per_key: int = 16, max_keys: int = 1024):
+        self.ttl = ttl
+        self.per_key = per_key
+        self.max_keys = max_keys
+        self._data: "OrderedDict[Any, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pop(self, key) -> Any:
+        """
+        Take the oldest unexpired item for key, or MISS.
+        """
+        now = time.time()
+        with self._lock:
+            items = self._data.get(key)
+            while items:
+                expires, value = items.pop(0)
+                if expires > now:
+                    if not items:
+                        del self._data[key]
+                    return value
+            self._data.pop(key, None)
+            return MISS
+
+    def put_many(self, key, values) -> None:
+        expires = time.time() + self.ttl
+        with self._lock:
+            items = self._data.setdefault(key, [])
+            for value in values:
+                if len(items) >= self.per_key:
+                    break
+                items.append((expires, value))
+            if not items:
+                del self._data[key]
+                return
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_keys:
+                self._data.popitem(last=False)
+
+    async def pop_async(self, key) -> Any:
+        return self.pop(key)
+
+    async def put_many_async(self, key, values) -> None:
+        self.put_many(key, values)
+
+    def size(self, key) -> int:
+        with self._lock:
+            return len(self._data.get(key, ()))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class SharedReadyPool(ReadyPool):
+    """
+    ReadyPool kept in the shared store (shared.py), so a caption pooled
+    by one worker can be served by any of them. Keys must be
+    JSON-serializable; idle keys expire with their newest item instead of
+    being LRU-bounded.
+    """
+
+    def __init__(self, store, ttl: float = 900, per_key: int = 16):
+        super().__init__(ttl, per_key)
+        self.store = store
+
+    def _key(self, key) -> str:
+        return "pool:" + json.dumps(key)
+
+    def pop(self, key) -> Any:
+        def take(items):
+            now = time.time()
+            while items:
+                expires, value = items.pop(0)
+                if expires > now:
+                    return items or None, value
+            return None, MISS
+        return self.store.update(self._key(key), take, ttl=self.ttl)
+
+    def put_many(self, key, values) -> None:
+        expires = time.time() + self.ttl
+
+        def extend(items):
+            items = items or []
+            for value in values:
+                if len(items) >= self.per_key:
+                    break
+                items.append([expires, value])
+            return items or None, None
+        self.store.update(self._key(key), extend, ttl=self.ttl)
+
+    async def pop_async(self, key) -> Any:
+        return await asyncio.to_thread(self.pop, key)
+
+    async def put_many_async(self, key, values) -> None:
+        await asyncio.to_thread(self.put_many, key, values)
+
+    def size(self, key) -> int:
+        now = time.time()
+        return sum(1 for expires, _ in self.store.get(self._key(key), []) if expires > now)
+
+    def clear(self) -> None:
+        self.store.delete_prefix("pool:")
+
+
+class ResponseCache:
+    """
+    Several distinct responses per key, served in rotation. get() misses
+    until a key holds per_key responses, so callers keep calling upstream
+    (and adding) until there is enough variety to rotate through. A key
+    expires ttl seconds after its first response; keys are LRU-bounded by
+    maxsize. With a path, keys are also written through to SQLite so they
+    survive restarts and are shared by workers. A ttl of 0 disables it.
+    """
+
+    def __init__(self, ttl: float = 3600, per_key: int = 4, maxsize: int = 4096, path: str = ""):
+        self.ttl = ttl
+        self.per_key = max(1, per_key)
+        self.maxsize = maxsize
+        self.enabled = ttl > 0 and maxsize > 0
+        self._data: "OrderedDict[str, list]" = OrderedDict()   # key -> [expires, values, next]
+        self._lock = threading.Lock()
+        self._conn = None
+        self._new_keys = 0
+        self.hits = 0
+        self.misses = 0
+        if path and self.enabled:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # WAL keeps the file consistent without an fsync per commit
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+            )
+            self._conn.commit()
+
+    def _entry(self, key: str, now: float) -> Optional[list]:
+        entry = self._data.get(key)
+        if entry is None and self._conn is not None:
+            row = self._conn.execute(
+                "SELECT expires, value FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                entry = self._data[key] = [row[0], json.loads(row[1]), 0]
+                # Most recently used, or it would be the next one evicted
+                self._data.move_to_end(key)
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        if entry is not None and entry[0] <= now:
+            self._data.pop(key, None)
+            return None
+        return entry
+
+    def get(self, key: str) -> Any:
+        if not self.enabled:
+            return MISS
+        with self._lock:
+            entry = self._entry(key, time.time())
+            if entry is None or len(entry[1]) < self.per_key:
+                self.misses += 1
+                return MISS
+            values, i = entry[1], entry[2]
+            entry[2] = (i + 1) % len(values)
+            self._data.move_to_end(key)
+            self.hits += 1
+            return values[i]
+
+    def add(self, key: str, values) -> None:
+        """
+        Store new distinct responses for key, up to per_key in total.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            entry = self._entry(key, now)
+            if entry is None:
+                entry = self._data[key] = [now + self.ttl, [], 0]
+                self._new_keys += 1
+            before = len(entry[1])
+            for value in values:
+                if len(entry[1]) >= self.per_key:
+                    break
+                if value and value not in entry[1]:
+                    entry[1].append(value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            if self._conn is not None and len(entry[1]) != before:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, expires, value) VALUES (?, ?, ?)",
+                    (key, entry[0], json.dumps(entry[1]))
+                )
+                if self._new_keys >= 64:
+                    self._new_keys = 0
+                    self._trim(now)
+                self._conn.commit()
+
+    def discard(self, key: str, value) -> None:
+        """
+        Drop one response (e.g. it repeats a caption served since), so the
+        key misses again until a fresh response takes its place.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entry(key, time.time())
+            if entry is None or value not in entry[1]:
+                return
+            entry[1].remove(value)
+            entry[2] = 0
+            if self._conn is not None:
+                self._conn.execute(
+                    "UPDATE responses SET value = ? WHERE key = ?", (json.dumps(entry[1]), key)
+                )
+                self._conn.commit()
+
+    # On the event loop: only a memory hit is served inline, anything that
+    # may touch SQLite runs in a worker thread
+    async def get_async(self, key: str) -> Any:
+        if self._conn is None or key in self._data:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def add_async(self, key: str, values) -> None:
+        if self._conn is None:
+            self.add(key, values)
+        else:
+            await asyncio.to_thread(self.add, key, values)
+
+    async def discard_async(self, key: str, value) -> None:
+        if self._conn is None:
+            self.discard(key, value)
+        else:
+            await asyncio.to_thread(self.discard, key, value)
+
+    def _trim(self, now: float) -> None:
+        # Expired rows, then the oldest beyond maxsize
+        self._conn.execute("DELETE FROM responses WHERE expires <= ?", (now,))
+        self._conn.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY expires DESC LIMIT ?)", (self.maxsize,)
+        )
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            if self._conn is not None:
+                self._conn.execute("DELETE FROM responses")
+                self._conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = len(self._data)
+            ready = sum(1 for e in self._data.values() if len(e[1]) >= self.per_key)
+        return {"keys": keys, "rotating": ready, "hits": self.hits, "misses": self.misses}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls for the same key: the first caller runs the
+    function, everyone else arriving while it is in flight waits for and
+    shares its result (or exception). Sync and async calls are tracked
+    separately.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, "_Call"] = {}
+        self._tasks: Dict[str, "asyncio.Task"] = {}
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = fn()
+            return call.value
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    async def do_async(self, key: str, coro_fn: Callable[[], Awaitable]) -> Any:
+        task = self._tasks.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(coro_fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._tasks.pop(key, None) if self._tasks.get(key) is t else None)
+        # Shield so one cancelled waiter doesn't cancel the shared call
+        return await asyncio.shield(task)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
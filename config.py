@@ -1,47 +1,397 @@
 # config.py
 
+import json
 import os
+import threading
+from dataclasses import dataclass, field, fields
 from pathlib import Path
+from typing import Callable, Dict, Mapping, Optional, Tuple, TypeVar
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# API Keys - read exclusively from environment variables
-DEEPSEEK_API_KEY = os.environ.get("DEEPSEEK_API_KEY")
-WEATHER_API_KEY = os.environ.get("WEATHER_API_KEY")
-TICKETMASTER_API_KEY = os.environ.get("TICKETMASTER_API_KEY")
+# Get the base directory of the application
+BASE_DIR = Path(__file__).resolve().parent
 
-# Add validation to ensure keys are set
-if not all([DEEPSEEK_API_KEY, WEATHER_API_KEY, TICKETMASTER_API_KEY]):
-    missing_keys = []
-    if not DEEPSEEK_API_KEY: missing_keys.append("DEEPSEEK_API_KEY")
-    if not WEATHER_API_KEY: missing_keys.append("WEATHER_API_KEY")
-    if not TICKETMASTER_API_KEY: missing_keys.append("TICKETMASTER_API_KEY")
-    print(f"WARNING: Missing API keys in .env file: {', '.join(missing_keys)}")
-    print("Please set these keys in your .env file.")
+SERVICES = ("weather", "news", "nominatim", "predicthq", "deepseek")
 
-# URLs
-URL_DEEPSEEK = "https://api.deepseek.com/chat/completions"
-URL_WEATHER = "http://api.weatherapi.com/v1/current.json"
-# (No need for Ticketmaster base URL here; we build it in code)
+# --- Typed runtime settings: endpoints, keys, timeouts, pools, caches, limits ---
 
-# Headers for DeepSeek
-HEADERS = {
-    "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
-    "Content-Type": "application/json"
-}
+class _Source:
+    """
+    Looks names up in the environment first, then in an optional JSON
+    settings file that uses the same variable names as keys.
+    """
 
-# Get the base directory of the application
-BASE_DIR = Path(__file__).resolve().parent
+    def __init__(self, environ: Mapping[str, str], file_values: Mapping[str, object]):
+        self.environ = environ
+        self.file_values = file_values
+
+    def get(self, name: str, default: str) -> str:
+        if name in self.environ:
+            return self.environ[name]
+        return str(self.file_values.get(name, default))
+
+    def get_int(self, name: str, default: int) -> int:
+        return int(self.get(name, str(default)))
+
+    def get_float(self, name: str, default: float) -> float:
+        return float(self.get(name, str(default)))
+
+    def get_bool(self, name: str, default: bool) -> bool:
+        return self.get(name, str(default)).lower() in ("1", "true", "yes")
+
+    def get_list(self, name: str, default: Tuple[str, ...], sep: str = ";") -> Tuple[str, ...]:
+        # A ";"-separated string in the environment, or a JSON list in the file
+        if name not in self.environ and isinstance(self.file_values.get(name), list):
+            return tuple(str(v).strip() for v in self.file_values[name] if str(v).strip())
+        value = self.get(name, sep.join(default))
+        return tuple(v.strip() for v in value.split(sep) if v.strip())
+
+    def per_service(self, prefix: str, defaults: Dict[str, float], cast=float) -> Dict[str, float]:
+        return {s: cast(self.get(f"{prefix}_{s.upper()}", str(defaults[s]))) for s in SERVICES}
+
+
+@dataclass
+class Settings:
+    """
+    Everything a deployment tunes, read once from the environment (and
+    SETTINGS_FILE, a JSON object of the same variable names) instead of
+    at import time in each module. Modules read it via get_settings() when
+    they build clients or make calls; configure() swaps it, e.g. before
+    startup in tests or the benchmark.
+    """
+
+    # API keys
+    deepseek_api_key: str = ""
+    weather_api_key: str = ""
+    ticketmaster_api_key: str = ""
+    predicthq_token: str = ""
+
+    # Upstream endpoints (point these at mirrors, proxies or local fakes)
+    url_deepseek: str = "https://api.deepseek.com/chat/completions"
+    url_weather: str = "http://api.weatherapi.com/v1/current.json"
+    url_news_rss: str = "https://news.google.com/rss/search"
+    url_nominatim: str = "https://nominatim.openstreetmap.org/search"
+    url_predicthq: str = "https://api.predicthq.com/v1/events/"
+    nominatim_user_agent: str = "CaptionBot/1.0"
+
+    # Shared keep-alive clients (http_client.py)
+    http_pool_size: int = 100
+    http_keepalive: int = 20
+    http_timeout: float = 15
+
+    # Upstream resilience (upstream.py): per-service timeouts (s) and retries,
+    # jittered backoff, circuit breaker, DeepSeek hedging (0 = off)
+    timeouts: Dict[str, float] = field(default_factory=lambda: {
+        "weather": 5, "news": 5, "nominatim": 5, "predicthq": 10, "deepseek": 30
+    })
+    retries: Dict[str, int] = field(default_factory=lambda: {
+        "weather": 2, "news": 2, "nominatim": 1, "predicthq": 2, "deepseek": 1
+    })
+    backoff_base: float = 0.2
+    backoff_max: float = 2
+    breaker_threshold: int = 5
+    breaker_reset: float = 30
+    deepseek_hedge_delay: float = 0
+    # Token bucket per service as (requests per second, burst); rate 0 = off.
+    # Nominatim's usage policy allows at most one request per second.
+    rate_limits: Dict[str, Tuple[float, int]] = field(default_factory=lambda: {
+        "weather": (10, 20), "news": (5, 10), "nominatim": (1, 1), "predicthq": (5, 10), "deepseek": (0, 0)
+    })
+
+    # Lookup cache (fetchers.py). TTLs in seconds; geocode 0 = never expire.
+    cache_backend: str = "memory"   # "memory" or "disk"
+    cache_maxsize: int = 2048
+    cache_ttl_weather: float = 600
+    cache_ttl_news: float = 900
+    cache_ttl_geocode: float = 0
+    cache_negative_ttl: float = 120
+
+    # DeepSeek response cache (deepseek.py): up to llm_cache_per_key distinct
+    # completions per normalized prompt, served in rotation; ttl 0 = off.
+    llm_cache_backend: str = "disk"   # "memory" or "disk"
+    llm_cache_ttl: float = 3600
+    llm_cache_per_key: int = 4
+    llm_cache_maxsize: int = 4096
+
+    # Near-duplicate index over served captions (dedupe.py): estimated Jaccard
+    # similarity that counts as a repeat (0 = off), and fresh DeepSeek calls
+    # made when every candidate is a repeat.
+    dedupe_threshold: float = 0.7
+    dedupe_retries: int = 1
+    # Captions count as served for this many days, and at most this many
+    # of the newest are kept (memory, disk and startup time scale with it)
+    dedupe_retention_days: float = 30
+    dedupe_max_entries: int = 100000
+
+    # No-repeat sampling scope for base prompts: "global", "location" or "persona"
+    no_repeat_scope: str = "global"
+
+    # Ready pool (api.py): ask DeepSeek for llm_choices completions per call
+    # and keep the extras for later requests with the same (style, location,
+    # persona). llm_choices = 1 disables the pool.
+    llm_choices: int = 1
+    ready_pool_ttl: float = 900
+    ready_pool_per_key: int = 16
+    ready_pool_max_keys: int = 1024
+
+    # Background prefetch of context for hot locations (prefetch.py);
+    # no prefetch_locations means data.US_CITIES
+    prefetch_enabled: bool = True
+    prefetch_locations: Tuple[str, ...] = ()
+    prefetch_interval: float = 300
+    prefetch_top_n: int = 20
+
+    # Local PredictHQ event index (events.py), filled by paged bulk ingestion,
+    # and event discovery across cities
+    event_index_max_age: float = 1800
+    event_radius_km: int = 25
+    event_days_ahead: int = 30
+    event_page_size: int = 100
+    event_ingest_max: int = 300
+    event_pick_window_days: int = 14
+    event_search_budget: float = 2.0
+
+    # Offline geocoding (gazetteer.py): similarity a fuzzy match needs
+    gazetteer_fuzzy_cutoff: float = 0.88
+
+    # Per-request tracing (?trace=1 or an X-Trace header on /generate).
+    # cProfile captures are off unless profile_enabled: then ?profile=1 on a
+    # traced request, or this sampled share of all requests, is profiled,
+    # keeping the newest profile_max_files captures
+    trace_enabled: bool = True
+    profile_enabled: bool = False
+    profile_sample_rate: float = 0
+    profile_max_files: int = 50
+
+    # Concurrency limits
+    batch_concurrency: int = 16
+    batch_max_items: int = 500
+    llm_max_concurrency: int = 8    # DeepSeek calls in flight (admission.py); 0 = no limit
+    llm_max_queue: int = 32
+    llm_queue_timeout: float = 10
+    llm_overload_status: int = 503  # 429 or 503 when a request is shed
+    llm_lock_dir: str = ""          # share llm_max_concurrency across workers; "" = per process
+    prefetch_concurrency: int = 4
+    event_search_workers: int = 8
 
-# File paths - updated for containerized environment
-DATA_DIR = Path(os.environ.get("DATA_DIR", os.path.join(BASE_DIR, "data")))
+    # "memory" keeps no-repeat bags, rate limits, the ready pool and the lookup
+    # cache per process; "sqlite" shares them (and DeepSeek slots) between
+    # all uvicorn workers through DATA_DIR/shared_state.sqlite3 (shared.py)
+    state_backend: str = "memory"
 
-# Make sure data directory exists
-os.makedirs(DATA_DIR, exist_ok=True)
+    data_dir: Path = BASE_DIR / "data"
 
-# File paths for caption data
-BAITY_CSV_PATH = os.path.join(DATA_DIR, "baity_captions.csv")
-OPINION_TXT_PATH = os.path.join(DATA_DIR, "opinion_captions.txt")
-OUTPUT_FILE_PATH = os.path.join(DATA_DIR, "mixed_style_captions.txt")
+    @classmethod
+    def from_env(cls, environ: Optional[Mapping[str, str]] = None, path: Optional[str] = None) -> "Settings":
+        environ = os.environ if environ is None else environ
+        path = path or environ.get("SETTINGS_FILE")
+        file_values = {}
+        if path:
+            with open(path, encoding="utf-8") as f:
+                file_values = json.load(f)
+        src = _Source(environ, file_values)
+        d = cls()
+        rate_defaults = d.rate_limits
+        return cls(
+            deepseek_api_key=src.get("DEEPSEEK_API_KEY", ""),
+            weather_api_key=src.get("WEATHER_API_KEY", ""),
+            ticketmaster_api_key=src.get("TICKETMASTER_API_KEY", ""),
+            predicthq_token=src.get("PREDICTHQ_TOKEN", ""),
+            url_deepseek=src.get("URL_DEEPSEEK", d.url_deepseek),
+            url_weather=src.get("URL_WEATHER", d.url_weather),
+            url_news_rss=src.get("URL_NEWS_RSS", d.url_news_rss),
+            url_nominatim=src.get("URL_NOMINATIM", d.url_nominatim),
+            url_predicthq=src.get("URL_PREDICTHQ", d.url_predicthq),
+            nominatim_user_agent=src.get("NOMINATIM_USER_AGENT", d.nominatim_user_agent),
+            http_pool_size=src.get_int("HTTP_POOL_SIZE", d.http_pool_size),
+            http_keepalive=src.get_int("HTTP_KEEPALIVE", d.http_keepalive),
+            http_timeout=src.get_float("HTTP_TIMEOUT", d.http_timeout),
+            timeouts=src.per_service("TIMEOUT", d.timeouts),
+            retries=src.per_service("RETRIES", d.retries, int),
+            backoff_base=src.get_float("UPSTREAM_BACKOFF_BASE", d.backoff_base),
+            backoff_max=src.get_float("UPSTREAM_BACKOFF_MAX", d.backoff_max),
+            breaker_threshold=src.get_int("BREAKER_THRESHOLD", d.breaker_threshold),
+            breaker_reset=src.get_float("BREAKER_RESET", d.breaker_reset),
+            deepseek_hedge_delay=src.get_float("DEEPSEEK_HEDGE_DELAY", d.deepseek_hedge_delay),
+            rate_limits={
+                s: (src.get_float(f"RATE_{s.upper()}", rate_defaults[s][0]),
+                    src.get_int(f"BURST_{s.upper()}", rate_defaults[s][1]))
+                for s in SERVICES
+            },
+            cache_backend=src.get("CACHE_BACKEND", d.cache_backend),
+            cache_maxsize=src.get_int("CACHE_MAXSIZE", d.cache_maxsize),
+            cache_ttl_weather=src.get_float("CACHE_TTL_WEATHER", d.cache_ttl_weather),
+            cache_ttl_news=src.get_float("CACHE_TTL_NEWS", d.cache_ttl_news),
+            cache_ttl_geocode=src.get_float("CACHE_TTL_GEOCODE", d.cache_ttl_geocode),
+            cache_negative_ttl=src.get_float("CACHE_NEGATIVE_TTL", d.cache_negative_ttl),
+            llm_cache_backend=src.get("LLM_CACHE_BACKEND", d.llm_cache_backend),
+            llm_cache_ttl=src.get_float("LLM_CACHE_TTL", d.llm_cache_ttl),
+            llm_cache_per_key=src.get_int("LLM_CACHE_PER_KEY", d.llm_cache_per_key),
+            llm_cache_maxsize=src.get_int("LLM_CACHE_MAXSIZE", d.llm_cache_maxsize),
+            dedupe_threshold=src.get_float("DEDUPE_THRESHOLD", d.dedupe_threshold),
+            dedupe_retries=src.get_int("DEDUPE_RETRIES", d.dedupe_retries),
+            dedupe_retention_days=src.get_float("DEDUPE_RETENTION_DAYS", d.dedupe_retention_days),
+            dedupe_max_entries=src.get_int("DEDUPE_MAX_ENTRIES", d.dedupe_max_entries),
+            no_repeat_scope=src.get("NO_REPEAT_SCOPE", d.no_repeat_scope),
+            llm_choices=src.get_int("LLM_CHOICES", d.llm_choices),
+            ready_pool_ttl=src.get_float("READY_POOL_TTL", d.ready_pool_ttl),
+            ready_pool_per_key=src.get_int("READY_POOL_PER_KEY", d.ready_pool_per_key),
+            ready_pool_max_keys=src.get_int("READY_POOL_MAX_KEYS", d.ready_pool_max_keys),
+            prefetch_enabled=src.get_bool("PREFETCH_ENABLED", d.prefetch_enabled),
+            prefetch_locations=src.get_list("PREFETCH_LOCATIONS", d.prefetch_locations),
+            prefetch_interval=src.get_float("PREFETCH_INTERVAL", d.prefetch_interval),
+            prefetch_top_n=src.get_int("PREFETCH_TOP_N", d.prefetch_top_n),
+            event_index_max_age=src.get_float("EVENT_INDEX_MAX_AGE", d.event_index_max_age),
+            event_radius_km=src.get_int("EVENT_RADIUS_KM", d.event_radius_km),
+            event_days_ahead=src.get_int("EVENT_DAYS_AHEAD", d.event_days_ahead),
+            event_page_size=src.get_int("EVENT_PAGE_SIZE", d.event_page_size),
+            event_ingest_max=src.get_int("EVENT_INGEST_MAX", d.event_ingest_max),
+            event_pick_window_days=src.get_int("EVENT_PICK_WINDOW_DAYS", d.event_pick_window_days),
+            event_search_budget=src.get_float("EVENT_SEARCH_BUDGET", d.event_search_budget),
+            gazetteer_fuzzy_cutoff=src.get_float("GAZETTEER_FUZZY_CUTOFF", d.gazetteer_fuzzy_cutoff),
+            trace_enabled=src.get_bool("TRACE_ENABLED", d.trace_enabled),
+            profile_enabled=src.get_bool("PROFILE_ENABLED", d.profile_enabled),
+            profile_sample_rate=src.get_float("PROFILE_SAMPLE_RATE", d.profile_sample_rate),
+            profile_max_files=src.get_int("PROFILE_MAX_FILES", d.profile_max_files),
+            batch_concurrency=src.get_int("BATCH_CONCURRENCY", d.batch_concurrency),
+            batch_max_items=src.get_int("BATCH_MAX_ITEMS", d.batch_max_items),
+            llm_max_concurrency=src.get_int("LLM_MAX_CONCURRENCY", d.llm_max_concurrency),
+            llm_max_queue=src.get_int("LLM_MAX_QUEUE", d.llm_max_queue),
+            llm_queue_timeout=src.get_float("LLM_QUEUE_TIMEOUT", d.llm_queue_timeout),
+            llm_overload_status=src.get_int("LLM_OVERLOAD_STATUS", d.llm_overload_status),
+            llm_lock_dir=src.get("LLM_LOCK_DIR", d.llm_lock_dir),
+            prefetch_concurrency=src.get_int("PREFETCH_CONCURRENCY", d.prefetch_concurrency),
+            event_search_workers=src.get_int("EVENT_SEARCH_WORKERS", d.event_search_workers),
+            state_backend=src.get("STATE_BACKEND", d.state_backend),
+            data_dir=Path(src.get("DATA_DIR", str(d.data_dir))),
+        )
+
+    @property
+    def cache_path(self) -> str:
+        return os.path.join(self.data_dir, "fetch_cache.sqlite3")
+
+    @property
+    def llm_cache_path(self) -> str:
+        return os.path.join(self.data_dir, "llm_cache.sqlite3")
+
+    @property
+    def dedupe_path(self) -> str:
+        return os.path.join(self.data_dir, "caption_index.sqlite3")
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.data_dir, "shared_state.sqlite3")
+
+    @property
+    def event_db_path(self) -> str:
+        return os.path.join(self.data_dir, "events.sqlite3")
+
+    @property
+    def gazetteer_db_path(self) -> str:
+        return os.path.join(self.data_dir, "gazetteer.sqlite3")
+
+    @property
+    def profile_dir(self) -> str:
+        return os.path.join(self.data_dir, "profiles")
+
+    # Caption data and main.py's default output
+    @property
+    def baity_csv_path(self) -> str:
+        return os.path.join(self.data_dir, "baity_captions.csv")
+
+    @property
+    def opinion_txt_path(self) -> str:
+        return os.path.join(self.data_dir, "opinion_captions.txt")
+
+    @property
+    def output_path(self) -> str:
+        return os.path.join(self.data_dir, "mixed_style_captions.txt")
+
+    def cache_ttl(self, source: str) -> Optional[float]:
+        """
+        TTL for a lookup source; None means the entry never expires.
+        """
+        ttl = getattr(self, f"cache_ttl_{source}")
+        return None if source == "geocode" and not ttl else ttl
+
+    def deepseek_headers(self) -> dict:
+        return {
+            "Authorization": f"Bearer {self.deepseek_api_key}",
+            "Content-Type": "application/json"
+        }
+
+    def predicthq_headers(self) -> dict:
+        return {
+            "Accept": "application/json",
+            "Authorization": f"Bearer {self.predicthq_token or 'YOUR_PREDICTHQ_TOKEN_HERE'}"
+        }
+
+    def missing_keys(self):
+        required = {
+            "DEEPSEEK_API_KEY": self.deepseek_api_key,
+            "WEATHER_API_KEY": self.weather_api_key,
+            "TICKETMASTER_API_KEY": self.ticketmaster_api_key,
+        }
+        return [name for name, value in required.items() if not value]
+
+    def as_dict(self, redact: bool = True) -> dict:
+        """
+        Plain dict of the settings, with API keys masked unless redact=False.
+        """
+        out = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if redact and (f.name.endswith("_key") or f.name.endswith("_token")):
+                value = "***" if value else ""
+            out[f.name] = str(value) if isinstance(value, Path) else value
+        return out
+
+
+settings = Settings.from_env()
+
+def get_settings() -> Settings:
+    return settings
+
+def configure(new: Settings) -> None:
+    """
+    Replace the active settings. Clients, caches and limiters built from
+    the old settings keep them, so call this before first use.
+    """
+    global settings
+    settings = new
+
+# --- Process-wide objects built on first use ---
+
+T = TypeVar("T")
+
+def lazy(factory: Callable[[], T]) -> Callable[[], T]:
+    """
+    Accessor for a process-wide object: the first call builds it with
+    factory(), from the settings active then, and later calls return the
+    same object. Concurrent first calls build it once. accessor.set(obj)
+    swaps in a replacement.
+    """
+    lock = threading.Lock()
+    slot: list = []
+
+    def get() -> T:
+        if not slot:
+            with lock:
+                if not slot:
+                    slot.append(factory())
+        return slot[0]
+
+    def replace(obj: T) -> None:
+        with lock:
+            slot[:] = [obj]
+
+    get.set = replace
+    return get
+
+# Add validation to ensure keys are set
+if settings.missing_keys():
+    print(f"WARNING: Missing API keys in .env file: {', '.join(settings.missing_keys())}")
+    print("Please set these keys in your .env file.")
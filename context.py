@@ -0,0 +1,169 @@
+import asyncio
+import random
+import threading
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from events import get_event_index
+from fetchers import (
+    city_name, normalize_location,
+    fetch_news_rss, fetch_news_rss_async,
+    fetch_weather, fetch_weather_async,
+    geocode, geocode_async
+)
+from metrics import stage
+
+# --- One location's weather/news/coordinates/events, fetched at most once ---
+
+class LocationContext:
+    """
+    Snapshot of the context for one location, shared by every prompt
+    builder that serves a request (or every request of a batch for that
+    location). The location is normalized once; weather, headline,
+    coordinates and indexed events are fetched lazily on first use and
+    memoized, failures included, so nothing is looked up twice. Concurrent
+    async callers share one in-flight fetch per value; sync callers in
+    threads wait on a per-value lock.
+    """
+
+    def __init__(self, location: str):
+        self.location = normalize_location(location)
+        self.city = city_name(self.location)
+        self.key = self.location.lower()
+        self._values: Dict[str, tuple] = {}           # name -> (value, error)
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def of(cls, location: Union[str, "LocationContext"]) -> "LocationContext":
+        return location if isinstance(location, cls) else cls(location)
+
+    def __repr__(self) -> str:
+        return f"LocationContext({self.location!r}, fetched={sorted(self._values)})"
+
+    # --- Memoization ---
+
+    @staticmethod
+    def _unwrap(entry: tuple):
+        value, error = entry
+        if error is not None:
+            raise error
+        return value
+
+    def _get(self, name: str, fetch: Callable):
+        entry = self._values.get(name)
+        if entry is None:
+            with self._lock:
+                lock = self._locks.setdefault(name, threading.Lock())
+            with lock:
+                entry = self._values.get(name)
+                if entry is None:
+                    try:
+                        entry = (fetch(), None)
+                    except Exception as e:
+                        entry = (None, e)
+                    self._values[name] = entry
+        return self._unwrap(entry)
+
+    async def _get_async(self, name: str, fetch: Callable):
+        entry = self._values.get(name)
+        if entry is None:
+            task = self._pending.get(name)
+            if task is None:
+                async def load():
+                    try:
+                        self._values[name] = (await fetch(), None)
+                    except Exception as e:
+                        self._values[name] = (None, e)
+                    finally:
+                        self._pending.pop(name, None)
+                task = self._pending[name] = asyncio.ensure_future(load())
+            # One caller being cancelled must not cancel the shared fetch
+            await asyncio.shield(task)
+            entry = self._values[name]
+        return self._unwrap(entry)
+
+    # --- Values ---
+
+    def weather(self) -> Tuple[str, Optional[str], Optional[str]]:
+        """
+        (condition, canonical city, region) from the weather API.
+        """
+        return self._get("weather", lambda: fetch_weather(self.location))
+
+    async def weather_async(self) -> Tuple[str, Optional[str], Optional[str]]:
+        return await self._get_async("weather", lambda: fetch_weather_async(self.location))
+
+    def headline(self) -> str:
+        return self._get("headline", lambda: fetch_news_rss(self.location))
+
+    async def headline_async(self) -> str:
+        return await self._get_async("headline", lambda: fetch_news_rss_async(self.location))
+
+    def coordinates(self) -> Optional[Tuple[float, float]]:
+        return self._get("coordinates", lambda: geocode(self.location))
+
+    async def coordinates_async(self) -> Optional[Tuple[float, float]]:
+        return await self._get_async("coordinates", lambda: geocode_async(self.location))
+
+    @property
+    def display_city(self) -> str:
+        """
+        The weather API's canonical city name once weather has been
+        fetched (without fetching it), else the first part of the location.
+        """
+        entry = self._values.get("weather")
+        if entry and entry[1] is None and entry[0][1]:
+            return entry[0][1]
+        return self.city
+
+    def _load_events(self) -> List[dict]:
+        index = get_event_index()
+        with stage("events"):
+            if index.stale([self.location]):
+                try:
+                    index.ingest(self.location, self.coordinates(), self.city)
+                except Exception as e:
+                    print(f"Event ingest failed for {self.location}: {e}")
+            return index.candidates(self.location)
+
+    async def _load_events_async(self) -> List[dict]:
+        index = get_event_index()
+        with stage("events"):
+            # SQLite reads and the ingest write run in a worker thread, off the loop
+            if await asyncio.to_thread(index.stale, [self.location]):
+                try:
+                    await index.ingest_async(self.location, await self.coordinates_async(), self.city)
+                except Exception as e:
+                    print(f"Event ingest failed for {self.location}: {e}")
+            return await asyncio.to_thread(index.candidates, self.location)
+
+    def events(self) -> List[dict]:
+        """
+        Usable indexed events near the location, ingesting the city first
+        if its index entry is missing or stale.
+        """
+        return self._get("events", self._load_events)
+
+    async def events_async(self) -> List[dict]:
+        return await self._get_async("events", self._load_events_async)
+
+    def event(self) -> dict:
+        """
+        A random one of events() for variety across captions, or
+        {"valid": False} when there is none.
+        """
+        events = self.events()
+        return random.choice(events) if events else {"valid": False}
+
+    async def event_async(self) -> dict:
+        events = await self.events_async()
+        return random.choice(events) if events else {"valid": False}
+
+    async def prefetch_async(self) -> None:
+        """
+        Fetch weather, headline and events concurrently (e.g. for a batch),
+        so the prompt builders that follow only read the snapshot.
+        """
+        await asyncio.gather(self.weather_async(), self.headline_async(), self.events_async(),
+                             return_exceptions=True)
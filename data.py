@@ -1,5 +1,10 @@
 import os
 import csv
+import threading
+import time
+from typing import Dict, List, Optional
+
+from templates import compile_caption
 
 # Major US cities list
 US_CITIES = [
@@ -9,37 +14,116 @@ US_CITIES = [
     "San Francisco", "Indianapolis", "Seattle", "Denver", "Washington"
 ]
 
-def load_captions():
-    """Load caption templates from CSV files"""
-    captions_dir = os.path.join(os.path.dirname(__file__), 'data')
+CAPTIONS_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+# Every corpus file the generators read, keyed by its name in Corpus
+CORPUS_FILES = {
+    "baity": "baity_captions.csv",
+    "opinion": "opinion_captions.txt",
+    "location": "location_captions.txt",
+    "references": "baity_references.txt",
+    "girlfriend_openers": "girlfriend_openers.txt",
+    "baity_openers": "baity_openers.txt",
+}
+
+def _read_baity_csv(path: str) -> List[str]:
     baity_captions = []
-    opinion_captions = []
-    
-    # Load baity captions
-    baity_path = os.path.join(captions_dir, 'baity_captions.csv')
-    if os.path.exists(baity_path):
-        with open(baity_path, 'r', encoding='utf-8') as f:
-            reader = csv.reader(f)
-            # Skip header row if it exists
-            header_skipped = False
-            for row in reader:
-                if not header_skipped:
-                    # Check if this is the header row (typically contains "Caption")
-                    if row and row[0].lower() == "caption":
-                        header_skipped = True
-                        continue
-                    else:
-                        header_skipped = True  # No header, but mark as skipped
-                
-                # Only add non-empty rows
-                if row and row[0].strip():
-                    baity_captions.append(row[0].strip())
-    
-    # Load opinion captions
-    opinion_path = os.path.join(captions_dir, 'opinion_captions.txt')
-    if os.path.exists(opinion_path):
-        with open(opinion_path, 'r', encoding='utf-8') as f:
-            opinion_captions = [line.strip() for line in f if line.strip()]
-    
-    print(f"Loaded {len(baity_captions)} baity captions and {len(opinion_captions)} opinion captions")
-    return baity_captions, opinion_captions
+    with open(path, 'r', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        # Skip header row if it exists
+        header_skipped = False
+        for row in reader:
+            if not header_skipped:
+                header_skipped = True
+                # Check if this is the header row (typically contains "Caption")
+                if row and row[0].lower() == "caption":
+                    continue
+
+            # Only add non-empty rows
+            if row and row[0].strip():
+                baity_captions.append(row[0].strip())
+    return baity_captions
+
+def _read_lines(path: str) -> List[str]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+class Corpus:
+    """
+    Immutable snapshot of every caption file plus views derived from them,
+    so request handlers never touch the disk or recompute filters.
+    """
+
+    def __init__(self, files: Dict[str, List[str]]):
+        self.baity = files.get("baity", [])
+        self.opinion = files.get("opinion", [])
+        self.location = files.get("location", [])
+        self.girlfriend_openers = files.get("girlfriend_openers", [])
+        self.baity_openers = files.get("baity_openers", [])
+        # Style references fall back to the baity captions themselves
+        self.baity_references = files.get("references", []) or self.baity
+        # Placeholder-free baity captions, usable verbatim
+        self.generic_baity = [c for c in self.baity if "{" not in c]
+        # Placeholder captions parsed once per load instead of per request
+        self.baity_templates = [compile_caption(c) for c in self.baity]
+        self.location_templates = [compile_caption(c) for c in self.location]
+
+class CorpusRegistry:
+    """
+    Loads all corpus files once and reloads them only when a file's mtime
+    changes (checked at most every check_interval seconds).
+    """
+
+    def __init__(self, directory: str = CAPTIONS_DIR, check_interval: float = 2.0):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._corpus: Optional[Corpus] = None
+        self._mtimes: Dict[str, Optional[float]] = {}
+        self._checked_at = 0.0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, CORPUS_FILES[name])
+
+    def _current_mtimes(self) -> Dict[str, Optional[float]]:
+        mtimes = {}
+        for name in CORPUS_FILES:
+            try:
+                mtimes[name] = os.path.getmtime(self._path(name))
+            except OSError:
+                mtimes[name] = None
+        return mtimes
+
+    def _load(self, mtimes: Dict[str, Optional[float]]) -> Corpus:
+        files = {}
+        for name, mtime in mtimes.items():
+            if mtime is None:
+                continue
+            path = self._path(name)
+            files[name] = _read_baity_csv(path) if name == "baity" else _read_lines(path)
+        corpus = Corpus(files)
+        print(f"Loaded {len(corpus.baity)} baity captions and {len(corpus.opinion)} opinion captions")
+        return corpus
+
+    def get(self) -> Corpus:
+        now = time.monotonic()
+        if self._corpus is not None and now - self._checked_at < self.check_interval:
+            return self._corpus
+        with self._lock:
+            if self._corpus is None or now - self._checked_at >= self.check_interval:
+                mtimes = self._current_mtimes()
+                if self._corpus is None or mtimes != self._mtimes:
+                    self._corpus = self._load(mtimes)
+                    self._mtimes = mtimes
+                self._checked_at = now
+        return self._corpus
+
+corpus_registry = CorpusRegistry()
+
+def get_corpus() -> Corpus:
+    return corpus_registry.get()
+
+def load_captions():
+    """Return the (baity, opinion) caption lists from the shared corpus"""
+    corpus = get_corpus()
+    return corpus.baity, corpus.opinion
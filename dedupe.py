@@ -0,0 +1,317 @@
+import asyncio
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from array import array
+from typing import List, Optional, Tuple
+
+from config import get_settings, lazy
+
+# --- Near-duplicate index over generated captions (MinHash + LSH bands) ---
+
+_PRIME = (1 << 61) - 1
+_WORD = re.compile(r"\w+")
+
+
+def shingles(text: str) -> set:
+    """
+    crc32 of each lowercased word bigram (single words for one-word text);
+    punctuation, emoji and spacing do not count.
+    """
+    words = _WORD.findall(text.lower())
+    if len(words) < 2:
+        return {zlib.crc32(w.encode("utf-8")) for w in words}
+    return {zlib.crc32(f"{a} {b}".encode("utf-8")) for a, b in zip(words, words[1:])}
+
+
+class DuplicateIndex:
+    """
+    MinHash signatures of recently served captions, bucketed by LSH bands
+    so a lookup only compares against captions sharing a band (a few dict
+    hits, well under a millisecond even with hundreds of thousands stored).
+    Captions whose estimated Jaccard similarity reaches `threshold` count
+    as near-duplicates. Only captions from the last `retention` seconds,
+    and at most the newest `max_entries`, are kept. With a path, captions
+    are written to SQLite in batches every `sync_interval` s, when rows
+    added by other workers are picked up too.
+    """
+
+    def __init__(self, threshold: float = 0.7, path: str = "", num_perm: int = 32, bands: int = 8,
+                 sync_interval: float = 2.0, max_entries: int = 100000, retention: float = 30 * 86400):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.sync_interval = sync_interval
+        self.max_entries = max_entries
+        self.retention = retention
+        # Fixed seed: signatures stored on disk must stay comparable
+        rng = random.Random(1)
+        self._perms = [(rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)) for _ in range(num_perm)]
+        self._signatures = array("Q")                     # num_perm values per caption
+        self._created = array("d")                        # time each caption was served
+        self._buckets = [dict() for _ in range(bands)]    # band hash -> position or [positions]
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pending: list = []                          # rows not yet written
+        self._last_rowid = 0
+        self._synced_at = 0.0
+        self._trimmed_at = 0.0
+        self._loaded = False
+
+    def __len__(self) -> int:
+        return len(self._created)
+
+    def signature(self, text: str) -> array:
+        hashes = shingles(text)
+        if not hashes:
+            return array("Q")
+        # One row of permuted values per shingle, then the column minimums
+        return array("Q", map(min, zip(*[[(a * h + b) % _PRIME for a, b in self._perms] for h in hashes])))
+
+    def _band_keys(self, sig) -> List[int]:
+        r = self.rows
+        return [hash(tuple(sig[i * r:(i + 1) * r])) for i in range(self.bands)]
+
+    def _insert(self, sig, created: float) -> None:
+        pos = len(self)
+        self._signatures.extend(sig)
+        self._created.append(created)
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            held = bucket.get(key)
+            if held is None:
+                bucket[key] = pos
+            elif isinstance(held, list):
+                held.append(pos)
+            else:
+                bucket[key] = [held, pos]
+
+    def _open(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # Autocommit mode, so the explicit BEGIN IMMEDIATE in _flush is honoured
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS captions "
+            "(id INTEGER PRIMARY KEY, created REAL, caption TEXT, signature BLOB)"
+        )
+        self._trim_rows(time.time())
+        self._sync()
+        self._trimmed_at = time.time()
+        print(f"Loaded {len(self)} captions into the duplicate index")
+
+    def load(self) -> None:
+        """
+        Read the stored captions now instead of on the first lookup.
+        """
+        with self._lock:
+            self._open()
+
+    def _sync(self) -> None:
+        """
+        Pull rows written since the last sync (by this or another worker).
+        """
+        rows = self._conn.execute(
+            "SELECT id, created, signature FROM captions WHERE id > ? ORDER BY id", (self._last_rowid,)
+        ).fetchall()
+        for rowid, created, blob in rows:
+            sig = array("Q")
+            sig.frombytes(blob)
+            if len(sig) == self.num_perm:
+                self._insert(sig, created)
+            self._last_rowid = rowid
+        self._synced_at = time.monotonic()
+
+    def _flush(self) -> None:
+        """
+        Write pending captions in one transaction. Other workers' rows are
+        synced first; ours are already in memory, so the rowid cursor skips
+        past them (no other writer can get in between under the lock).
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._sync()
+            if self._pending:
+                self._conn.executemany(
+                    "INSERT INTO captions (created, caption, signature) VALUES (?, ?, ?)", self._pending
+                )
+                self._last_rowid = self._conn.execute("SELECT max(id) FROM captions").fetchone()[0]
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._pending = []
+
+    def _trim_rows(self, now: float) -> None:
+        self._conn.execute("DELETE FROM captions WHERE created <= ?", (now - self.retention,))
+        self._conn.execute(
+            "DELETE FROM captions WHERE id <= "
+            "(SELECT id FROM captions ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.max_entries,)
+        )
+
+    def _trim(self, now: float) -> None:
+        """
+        Drop captions past the retention window or beyond max_entries and
+        rebuild the buckets from what is left.
+        """
+        n = self.num_perm
+        cutoff = now - self.retention
+        first = max(0, len(self) - self.max_entries)
+        keep = [pos for pos in range(first, len(self)) if self._created[pos] > cutoff]
+        signatures, created = self._signatures, self._created
+        self._signatures, self._created = array("Q"), array("d")
+        self._buckets = [dict() for _ in range(self.bands)]
+        for pos in keep:
+            self._insert(signatures[pos * n:(pos + 1) * n], created[pos])
+        if self._conn is not None:
+            self._trim_rows(now)
+        self._trimmed_at = now
+
+    def _refresh(self) -> None:
+        self._open()
+        now = time.time()
+        # Amortized: rebuild at 10% over the cap, or (at most hourly) once
+        # the oldest caption has left the retention window
+        expired = len(self) and self._created[0] <= now - self.retention
+        if len(self) > self.max_entries * 1.1 or (expired and now - self._trimmed_at >= 3600):
+            self._trim(now)
+        if self._conn is not None and (
+                len(self._pending) >= 64 or time.monotonic() - self._synced_at >= self.sync_interval):
+            self._flush()
+
+    def _nearest(self, sig, skip_identical: bool = False) -> Tuple[Optional[int], float, bool]:
+        """
+        Closest stored caption sharing a band, its similarity, and whether
+        one with exactly this signature was seen. With skip_identical,
+        those identical ones are not candidates.
+        """
+        best, best_sim, identical = None, 0.0, False
+        seen = set()
+        n = self.num_perm
+        stored = self._signatures
+        for bucket, key in zip(self._buckets, self._band_keys(sig)):
+            held = bucket.get(key)
+            if held is None:
+                continue
+            for pos in (held if isinstance(held, list) else (held,)):
+                if pos in seen:
+                    continue
+                seen.add(pos)
+                base = pos * n
+                sim = sum(1 for i in range(n) if stored[base + i] == sig[i]) / n
+                if sim == 1.0:
+                    identical = True
+                    if skip_identical:
+                        continue
+                if sim > best_sim:
+                    best, best_sim = pos, sim
+        return best, best_sim, identical
+
+    def similarity(self, text: str) -> float:
+        """
+        Estimated Jaccard similarity to the closest stored caption (0 if none).
+        """
+        sig = self.signature(text)
+        if not sig:
+            return 0.0
+        with self._lock:
+            self._refresh()
+            return self._nearest(sig)[1]
+
+    def is_duplicate(self, text: str) -> bool:
+        return self.threshold > 0 and self.similarity(text) >= self.threshold
+
+    def _record(self, text: str, sig) -> None:
+        now = time.time()
+        self._insert(sig, now)
+        if self._conn is not None:
+            self._pending.append((now, text, sig.tobytes()))
+
+    def add(self, text: str) -> None:
+        """
+        Record a caption as served. It counts for lookups right away and
+        reaches SQLite (and other workers) with the next batch.
+        """
+        if self.threshold <= 0:
+            return
+        sig = self.signature(text)
+        if not sig:
+            return
+        with self._lock:
+            self._refresh()
+            self._record(text, sig)
+
+    def check_and_add(self, text: str, repeat_ok: bool = False) -> bool:
+        """
+        True (and the caption is recorded) if it is not a near-duplicate.
+        The lookup and the insert happen under one lock, so two threads
+        cannot both pass with near-identical captions. With repeat_ok
+        (a cached completion served again), earlier servings of this same
+        caption do not count, and it is not recorded a second time.
+        """
+        if self.threshold <= 0:
+            return True
+        sig = self.signature(text)
+        if not sig:
+            return True
+        with self._lock:
+            self._refresh()
+            _, sim, identical = self._nearest(sig, skip_identical=repeat_ok)
+            if sim >= self.threshold:
+                return False
+            if not identical:
+                self._record(text, sig)
+        return True
+
+    def flush(self) -> None:
+        """
+        Write pending captions now (e.g. at shutdown).
+        """
+        with self._lock:
+            if self._conn is not None and self._pending:
+                self._flush()
+
+    # On the event loop: with a path any call may sync or flush SQLite, so
+    # it runs in a worker thread
+    async def is_duplicate_async(self, text: str) -> bool:
+        if not self.path or self.threshold <= 0:
+            return self.is_duplicate(text)
+        return await asyncio.to_thread(self.is_duplicate, text)
+
+    async def add_async(self, text: str) -> None:
+        if not self.path or self.threshold <= 0:
+            self.add(text)
+        else:
+            await asyncio.to_thread(self.add, text)
+
+    async def check_and_add_async(self, text: str, repeat_ok: bool = False) -> bool:
+        if not self.path or self.threshold <= 0:
+            return self.check_and_add(text, repeat_ok)
+        return await asyncio.to_thread(self.check_and_add, text, repeat_ok)
+
+    def stats(self) -> dict:
+        return {"captions": len(self), "pending": len(self._pending), "threshold": self.threshold,
+                "max_entries": self.max_entries, "retention": self.retention, "path": self.path}
+
+
+def _make_index() -> DuplicateIndex:
+    settings = get_settings()
+    return DuplicateIndex(settings.dedupe_threshold, settings.dedupe_path,
+                          max_entries=settings.dedupe_max_entries,
+                          retention=settings.dedupe_retention_days * 86400)
+
+# Stored captions are read on the index's first lookup, or by load()
+get_caption_index = lazy(_make_index)
@@ -0,0 +1,150 @@
+import hashlib
+import json
+import random
+
+import httpx
+
+import upstream
+from cache import ResponseCache
+from config import get_settings, lazy
+from http_client import get_async_client
+from metrics import UPSTREAM_ERRORS
+import tracing
+
+# --- DeepSeek chat completions over the shared pooled clients ---
+
+def build_payload(system: str, user_msg: str, **overrides) -> dict:
+    """
+    Build the chat-completions payload used by the API. Keyword overrides
+    replace sampling fields (e.g. stream=False for the CLI).
+    """
+    payload = {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": system},
+            {"role": "user",   "content": user_msg}
+        ],
+        "n": 1,
+        "max_tokens": 60,
+        "temperature": random.uniform(0.7, 0.85),
+        "top_p": 0.9
+    }
+    payload.update(overrides)
+    return payload
+
+def extract_text(data: dict) -> str:
+    return data["choices"][0]["message"]["content"].strip()
+
+def extract_texts(data: dict) -> list:
+    """
+    Every choice's text, for payloads sent with n > 1.
+    """
+    return [c["message"]["content"].strip() for c in data["choices"]]
+
+def complete(payload: dict) -> str:
+    """
+    Blocking completion; raises requests.exceptions.RequestException on
+    failure, or upstream.CircuitOpenError while DeepSeek is marked down.
+    """
+    settings = get_settings()
+    resp = upstream.post("deepseek", settings.url_deepseek, json=payload, headers=settings.deepseek_headers())
+    resp.raise_for_status()
+    return extract_text(resp.json())
+
+async def complete_async(payload: dict) -> str:
+    """
+    Non-blocking completion; raises httpx.HTTPError on failure, or
+    upstream.CircuitOpenError while DeepSeek is marked down. Hedged when
+    deepseek_hedge_delay is set.
+    """
+    settings = get_settings()
+    resp = await upstream.post_async(
+        "deepseek", settings.url_deepseek, hedge_delay=settings.deepseek_hedge_delay,
+        json=payload, headers=settings.deepseek_headers()
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    tracing.note(usage=data.get("usage"))
+    return extract_text(data)
+
+async def complete_many_async(payload: dict) -> list:
+    """
+    Non-blocking completion returning all n choices.
+    """
+    settings = get_settings()
+    resp = await upstream.post_async(
+        "deepseek", settings.url_deepseek, hedge_delay=settings.deepseek_hedge_delay,
+        json=payload, headers=settings.deepseek_headers()
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    tracing.note(usage=data.get("usage"))
+    return extract_texts(data)
+
+async def stream_async(payload: dict):
+    """
+    Yield content deltas from a streamed completion as they arrive.
+    Raises httpx.HTTPError on failure; closing the generator early closes
+    the upstream connection.
+    """
+    payload = dict(payload, stream=True)
+    settings = get_settings()
+    cb = upstream.breaker("deepseek")
+    cb.check()
+    await upstream.bucket("deepseek").acquire_async()
+    try:
+        async with get_async_client().stream(
+            "POST", settings.url_deepseek, json=payload, headers=settings.deepseek_headers(),
+            timeout=settings.timeouts["deepseek"]
+        ) as resp:
+            resp.raise_for_status()
+            cb.record_success()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    yield delta
+    except httpx.HTTPStatusError as e:
+        UPSTREAM_ERRORS.inc(service="deepseek", kind="status")
+        if e.response.status_code in upstream.RETRY_STATUSES:
+            cb.record_failure()
+        raise
+    except httpx.TransportError:
+        UPSTREAM_ERRORS.inc(service="deepseek", kind="transport")
+        cb.record_failure()
+        raise
+
+# --- Response cache keyed by normalized prompt ---
+
+def response_key(payload: dict) -> str:
+    """
+    Hash of the model, whitespace-normalized messages and a sampling bucket
+    (temperature to one decimal, top_p, max_tokens), so payloads that only
+    differ in jitter share cached completions.
+    """
+    temperature = payload.get("temperature")
+    normalized = {
+        "model": payload.get("model"),
+        "messages": [(m.get("role"), " ".join(str(m.get("content", "")).split()))
+                     for m in payload.get("messages", [])],
+        "sampling": (None if temperature is None else round(temperature, 1),
+                     payload.get("top_p"), payload.get("max_tokens")),
+    }
+    raw = json.dumps(normalized, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _make_response_cache() -> ResponseCache:
+    settings = get_settings()
+    return ResponseCache(
+        ttl=settings.llm_cache_ttl,
+        per_key=settings.llm_cache_per_key,
+        maxsize=settings.llm_cache_maxsize,
+        path=settings.llm_cache_path if settings.llm_cache_backend == "disk" else ""
+    )
+
+get_response_cache = lazy(_make_response_cache)
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from config import get_settings, lazy
+from fetchers import fetch_predicthq_events, fetch_predicthq_events_async, in_flight, normalize_location
+from metrics import timed
+
+# --- Local index of PredictHQ events, keyed by city, date and category ---
+
+def event_date(ev: dict) -> Optional[date]:
+    iso_dt = ev.get("date") or ""
+    if len(iso_dt) < 10:
+        return None
+    try:
+        return date.fromisoformat(iso_dt[:10])
+    except ValueError:
+        return None
+
+def is_usable(ev: dict) -> bool:
+    """
+    Same window the prompt builders accept: valid, has an artist, and not
+    more than two days in the past.
+    """
+    d = event_date(ev)
+    return bool(ev.get("valid") and ev.get("artist") and d and (d - date.today()).days >= -2)
+
+def _rank(city: str, ev: dict) -> tuple:
+    # Soonest upcoming first, then most recent past; city name breaks ties
+    delta = (event_date(ev) - date.today()).days
+    return (0 if delta >= 0 else 1, abs(delta), city)
+
+def _city_key(location: str) -> str:
+    return normalize_location(location).lower()
+
+
+class EventIndex:
+    """
+    Events ingested in bulk per city (one paged PredictHQ query each) and
+    stored in SQLite under DATA_DIR, so event prompts are local lookups.
+    A city is re-ingested once its last ingest is older than max_age; a
+    city with no events is remembered too, so it is not re-queried.
+    """
+
+    def __init__(self, path: str, max_age: float = 1800):
+        self.max_age = max_age
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                city_key TEXT, day TEXT, category TEXT,
+                title TEXT, venue TEXT, start TEXT, city TEXT
+            );
+            CREATE INDEX IF NOT EXISTS events_city_day ON events (city_key, day);
+            CREATE TABLE IF NOT EXISTS regions (city_key TEXT PRIMARY KEY, ingested_at REAL);
+        """)
+        self._conn.commit()
+
+    def replace_city(self, location: str, events: List[dict]) -> None:
+        key = _city_key(location)
+        rows = [
+            (key, ev["date"][:10], ev.get("category", ""), ev["artist"],
+             ev.get("venue", ""), ev["date"], ev.get("city", location))
+            for ev in events
+            if ev.get("valid") and ev.get("artist") and event_date(ev)
+        ]
+        with self._lock:
+            self._conn.execute("DELETE FROM events WHERE city_key = ?", (key,))
+            self._conn.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO regions VALUES (?, ?)", (key, time.time())
+            )
+            self._conn.commit()
+
+    def stale(self, cities: Iterable[str]) -> List[str]:
+        cutoff = time.time() - self.max_age
+        with self._lock:
+            fresh = {
+                row[0] for row in self._conn.execute(
+                    "SELECT city_key FROM regions WHERE ingested_at > ?", (cutoff,)
+                )
+            }
+        return [c for c in cities if _city_key(c) not in fresh]
+
+    def query(self, location: str, date_from: Optional[date] = None, date_to: Optional[date] = None,
+              category: Optional[str] = None, limit: Optional[int] = None) -> List[dict]:
+        """
+        Indexed events for a city, soonest first, as event dicts.
+        """
+        sql = "SELECT title, venue, start, city, category FROM events WHERE city_key = ?"
+        args: list = [_city_key(location)]
+        if date_from:
+            sql += " AND day >= ?"
+            args.append(date_from.isoformat())
+        if date_to:
+            sql += " AND day <= ?"
+            args.append(date_to.isoformat())
+        if category:
+            sql += " AND category = ?"
+            args.append(category)
+        sql += " ORDER BY day, start"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(sql, args).fetchall()
+        return [
+            {"valid": True, "artist": title, "venue": venue, "city": city,
+             "date": start, "event": title, "category": cat}
+            for title, venue, start, city, cat in rows
+        ]
+
+    def _usable(self, location: str, window_days: Optional[int] = None) -> List[dict]:
+        today = date.today()
+        date_to = today + timedelta(days=window_days) if window_days is not None else None
+        return [ev for ev in self.query(location, today - timedelta(days=2), date_to) if is_usable(ev)]
+
+    def best(self, cities: Iterable[str]) -> Optional[Tuple[str, dict]]:
+        """
+        Deterministic pick across cities: the soonest upcoming usable event.
+        """
+        found = [(c, evs[0]) for c in cities for evs in [self._usable(c)] if evs]
+        if not found:
+            return None
+        return min(found, key=lambda item: _rank(*item))
+
+    def candidates(self, location: str, window_days: Optional[int] = None) -> List[dict]:
+        """
+        Usable events in the next `window_days` (EVENT_PICK_WINDOW_DAYS) for
+        one city, or anything usable if there are none in the window.
+        """
+        if window_days is None:
+            window_days = get_settings().event_pick_window_days
+        return self._usable(location, window_days) or self._usable(location)
+
+    def ingest(self, location: str, coords: Optional[Tuple[float, float]] = None, city: str = "") -> None:
+        """
+        Fetch and store a city's events. Concurrent ingests of the same city
+        share one fetch (as do concurrent async ones).
+        """
+        def load():
+            self.replace_city(location, fetch_predicthq_events(location, coords=coords, city=city))
+
+        in_flight.do(f"ingest:{_city_key(location)}", load)
+
+    async def ingest_async(self, location: str, coords: Optional[Tuple[float, float]] = None,
+                           city: str = "") -> None:
+        async def load():
+            events = await fetch_predicthq_events_async(location, coords=coords, city=city)
+            await asyncio.to_thread(self.replace_city, location, events)
+
+        await in_flight.do_async(f"ingest:{_city_key(location)}", load)
+
+    async def refresh_async(self, cities: Iterable[str], concurrency: int = 4) -> None:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def refresh(city):
+            async with semaphore:
+                try:
+                    await self.ingest_async(city)
+                except Exception as e:
+                    print(f"Event ingest failed for {city}: {e}")
+
+        await asyncio.gather(*(refresh(c) for c in cities))
+
+    async def ensure_async(self, cities: Iterable[str], concurrency: int = 4) -> None:
+        """
+        Ingest only the cities that are missing or stale.
+        """
+        await self.refresh_async(await asyncio.to_thread(self.stale, list(cities)), concurrency)
+
+
+def _open_index() -> EventIndex:
+    settings = get_settings()
+    return EventIndex(settings.event_db_path, settings.event_index_max_age)
+
+def _make_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=get_settings().event_search_workers,
+                              thread_name_prefix="event-search")
+
+get_event_index = lazy(_open_index)
+_get_executor = lazy(_make_executor)
+
+@timed("events")
+def find_event(cities: List[str], budget: Optional[float] = None) -> Optional[Tuple[str, dict]]:
+    """
+    Best usable (city, event) among `cities`. Serves from the index when it
+    can; otherwise ingests the stale cities in parallel and waits at most
+    `budget` seconds (EVENT_SEARCH_BUDGET). Ingests still running at the
+    deadline keep going and land in the index for the next caller.
+    """
+    index = get_event_index()
+    hit = index.best(cities)
+    if hit:
+        return hit
+
+    executor = _get_executor()
+    futures = [executor.submit(index.ingest, city) for city in index.stale(cities)]
+    if futures:
+        wait(futures, timeout=get_settings().event_search_budget if budget is None else budget)
+    return index.best(cities)
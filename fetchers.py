@@ -1,114 +1,369 @@
-import os
+import asyncio
+import functools
 import requests
 import feedparser
 import random
 from urllib.parse import quote_plus
-from typing import Optional, Tuple
+from datetime import date, timedelta
+from typing import Callable, List, Optional, Tuple
 
-from config import URL_WEATHER, WEATHER_API_KEY
+from cache import MISS, SingleFlight, SQLiteCache, TTLCache
+from config import get_settings, lazy
+from gazetteer import get_gazetteer
+from metrics import CACHE_LOOKUPS, stage
+import tracing
+import upstream
+
+# --- Location strings ---
+def normalize_location(location: str) -> str:
+    """
+    Location with surrounding and repeated whitespace removed; the form
+    lookups are keyed and sent upstream by.
+    """
+    return " ".join(location.split())
+
+def city_name(location: str) -> str:
+    # "Austin, TX" -> "Austin"
+    return location.split(",")[0].strip()
+
+# --- Lookup cache shared by the sync and async fetchers ---
+def _make_cache() -> TTLCache:
+    settings = get_settings()
+    # Workers sharing state also share lookups through the SQLite file
+    if settings.cache_backend == "disk" or settings.state_backend == "sqlite":
+        return SQLiteCache(settings.cache_path, settings.cache_maxsize)
+    return TTLCache(settings.cache_maxsize)
+
+get_cache = lazy(_make_cache)
+# Coalesces concurrent cache misses for the same lookup
+in_flight = SingleFlight()
+
+def set_cache(cache: TTLCache) -> None:
+    """
+    Swap the lookup cache backend (e.g. a SQLiteCache or a no-op for tests).
+    """
+    get_cache.set(cache)
+
+def _cache_key(source: str, location: str, args: tuple, kwargs: dict) -> str:
+    parts = [source, normalize_location(location).lower()]
+    parts += [str(a) for a in args]
+    parts += [f"{k}={kwargs[k]}" for k in sorted(kwargs)]
+    return ":".join(parts)
+
+def _as_tuple(value):
+    # Disk-backed entries come back from JSON as lists
+    return tuple(value) if isinstance(value, list) else value
+
+def _cached(source: str, is_negative: Callable[[object], bool], decode: Optional[Callable] = None):
+    """
+    Cache a fetcher by (source, normalized location, extra args). "Not found"
+    answers are cached for cache_negative_ttl; exceptions are never cached.
+    Works for both plain and async fetchers, which share one key space.
+    Concurrent misses for the same key share one upstream call.
+    The wrapper's .refresh() always calls upstream and overwrites the entry.
+    """
+    def ttl_for(value):
+        settings = get_settings()
+        return settings.cache_negative_ttl if is_negative(value) else settings.cache_ttl(source)
+
+    def store(key, value):
+        get_cache().set(key, value, ttl_for(value))
+
+    async def store_async(key, value):
+        await get_cache().set_async(key, value, ttl_for(value))
+
+    def found(value):
+        result = "miss" if value is MISS else "hit"
+        CACHE_LOOKUPS.inc(source=source, result=result)
+        tracing.record("cache", source=source, result=result)
+        if value is not MISS and decode:
+            value = decode(value)
+        return value
+
+    def lookup(key):
+        return found(get_cache().get(key))
+
+    async def lookup_async(key):
+        return found(await get_cache().get_async(key))
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(location: str, *args, **kwargs):
+                with stage(source):
+                    key = _cache_key(source, location, args, kwargs)
+                    value = await lookup_async(key)
+                    if value is MISS:
+                        async def load():
+                            result = await fn(location, *args, **kwargs)
+                            await store_async(key, result)
+                            return result
+                        value = await in_flight.do_async(key, load)
+                    return value
+
+            async def async_refresh(location: str, *args, **kwargs):
+                value = await fn(location, *args, **kwargs)
+                await store_async(_cache_key(source, location, args, kwargs), value)
+                return value
+
+            async_wrapper.refresh = async_refresh
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(location: str, *args, **kwargs):
+            with stage(source):
+                key = _cache_key(source, location, args, kwargs)
+                value = lookup(key)
+                if value is MISS:
+                    def load():
+                        result = fn(location, *args, **kwargs)
+                        store(key, result)
+                        return result
+                    value = in_flight.do(key, load)
+                return value
+
+        def refresh(location: str, *args, **kwargs):
+            value = fn(location, *args, **kwargs)
+            store(_cache_key(source, location, args, kwargs), value)
+            return value
+
+        wrapper.refresh = refresh
+        return wrapper
+    return decorator
+
+def _weather_missing(value) -> bool:
+    return value[1] is None
+
+def _news_missing(value) -> bool:
+    return value.startswith("No trending news")
+
+def _geocode_missing(value) -> bool:
+    return value is None
+
+WEATHER_DESCRIPTIONS = {
+    "sunny": "bright and sunny",
+    "cloudy": "a bit cloudy",
+    "partly cloudy": "a mix of sun and clouds",
+    "rainy": "a little rainy",
+    "stormy": "wild and stormy",
+    "clear": "clear and beautiful",
+    "snowy": "a winter wonderland"
+}
 
 # --- Existing weather fetcher ---
+def _weather_params(location: str) -> dict:
+    return {"key": get_settings().weather_api_key, "q": location, "aqi": "no"}
+
+def _parse_weather(data: dict) -> Tuple[str, str, str]:
+    city = data['location']['name']
+    state = data['location']['region']
+    condition = data['current']['condition']['text'].lower()
+    weather_condition = WEATHER_DESCRIPTIONS.get(condition, condition)
+    return weather_condition, city, state
+
+@_cached("weather", _weather_missing, _as_tuple)
 def fetch_weather(location: str) -> Tuple[str, str, str]:
-    url_call = f"{URL_WEATHER}?key={WEATHER_API_KEY}&q={location}&aqi=no"
-    response = requests.get(url_call)
+    response = upstream.get("weather", get_settings().url_weather, params=_weather_params(location))
     if response.status_code == 200:
-        data = response.json()
-        city = data['location']['name']
-        state = data['location']['region']
-        condition = data['current']['condition']['text'].lower()
-        weather_descriptions = {
-            "sunny": "bright and sunny",
-            "cloudy": "a bit cloudy",
-            "partly cloudy": "a mix of sun and clouds",
-            "rainy": "a little rainy",
-            "stormy": "wild and stormy",
-            "clear": "clear and beautiful",
-            "snowy": "a winter wonderland"
-        }
-        weather_condition = weather_descriptions.get(condition, condition)
-        return weather_condition, city, state
+        return _parse_weather(response.json())
+    else:
+        print(f"Weather API Error {response.status_code}: {response.text}")
+        return "Could not fetch weather data", None, None
+
+@_cached("weather", _weather_missing, _as_tuple)
+async def fetch_weather_async(location: str) -> Tuple[str, str, str]:
+    response = await upstream.get_async("weather", get_settings().url_weather, params=_weather_params(location))
+    if response.status_code == 200:
+        return _parse_weather(response.json())
     else:
         print(f"Weather API Error {response.status_code}: {response.text}")
         return "Could not fetch weather data", None, None
 
 # --- Existing news fetcher ---
-def fetch_news_rss(city: str) -> str:
+def _news_feed_url(city: str) -> str:
     city_encoded = quote_plus(city)
-    feed_url = (
-        f"https://news.google.com/rss/search?"
+    return (
+        f"{get_settings().url_news_rss}?"
         f"q={city_encoded}+news&hl=en-US&gl=US&ceid=US:en"
     )
-    feed = feedparser.parse(feed_url)
+
+def _first_headline(feed, city: str) -> str:
     if feed.entries:
         return feed.entries[0].title
     return f"No trending news in {city}."
 
+@_cached("news", _news_missing)
+def fetch_news_rss(city: str) -> str:
+    # Download over the pooled session, then let feedparser parse the bytes
+    resp = upstream.get("news", _news_feed_url(city))
+    return _first_headline(feedparser.parse(resp.content), city)
+
+@_cached("news", _news_missing)
+async def fetch_news_rss_async(city: str) -> str:
+    resp = await upstream.get_async("news", _news_feed_url(city))
+    return _first_headline(feedparser.parse(resp.content), city)
+
 # --- Geocoding helper using OpenStreetMap Nominatim ---
+def _nominatim_request(location: str) -> Tuple[str, dict, dict]:
+    settings = get_settings()
+    params = {"q": location, "format": "json", "limit": 1}
+    return settings.url_nominatim, params, {"User-Agent": settings.nominatim_user_agent}
+
+def _parse_geocode(data: list) -> Optional[Tuple[float, float]]:
+    if not data:
+        return None
+    lat = float(data[0]["lat"])
+    lon = float(data[0]["lon"])
+    return lat, lon
+
+@_cached("geocode", _geocode_missing, _as_tuple)
 def geocode(location: str) -> Optional[Tuple[float, float]]:
     """
-    Convert any location string into latitude and longitude via Nominatim.
+    Convert any location string into latitude and longitude. The offline
+    gazetteer answers first; Nominatim is only asked on a miss, and its
+    answer is written back to the gazetteer.
     Returns (lat, lon) or None if not found.
     """
-    url = "https://nominatim.openstreetmap.org/search"
-    params = {"q": location, "format": "json", "limit": 1}
-    headers = {"User-Agent": "CaptionBot/1.0"}
+    coords = get_gazetteer().lookup(location)
+    if coords:
+        return coords
+    url, params, headers = _nominatim_request(location)
     try:
-        resp = requests.get(url, params=params, headers=headers, timeout=5)
+        resp = upstream.get("nominatim", url, params=params, headers=headers)
         resp.raise_for_status()
-        data = resp.json()
-        if not data:
-            return None
-        lat = float(data[0]["lat"])
-        lon = float(data[0]["lon"])
-        return lat, lon
+        coords = _parse_geocode(resp.json())
     except Exception:
         return None
+    if coords:
+        get_gazetteer().learn(location, coords)
+    return coords
 
-# --- PredictHQ event fetcher with geocoding ---
-PREDICTHQ_TOKEN = os.getenv("PREDICTHQ_TOKEN") or "YOUR_PREDICTHQ_TOKEN_HERE"
+@_cached("geocode", _geocode_missing, _as_tuple)
+async def geocode_async(location: str) -> Optional[Tuple[float, float]]:
+    gazetteer = get_gazetteer()
+    # Fuzzy matching (difflib) and the learned-place write run off the loop
+    coords = gazetteer.exact(location) or await asyncio.to_thread(gazetteer.lookup, location)
+    if coords:
+        return coords
+    url, params, headers = _nominatim_request(location)
+    try:
+        resp = await upstream.get_async("nominatim", url, params=params, headers=headers)
+        resp.raise_for_status()
+        coords = _parse_geocode(resp.json())
+    except Exception:
+        return None
+    if coords:
+        await asyncio.to_thread(gazetteer.learn, location, coords)
+    return coords
 
-def fetch_predicthq_event(location: str, radius_km: int = 25) -> dict:
-    """
-    Fetch one upcoming event from PredictHQ around any location string.
-    Returns dict with keys: valid, artist, venue, city, date, event.
-    """
-    coords = geocode(location)
-    if not coords:
-        return {"valid": False}
+# --- PredictHQ bulk fetch (feeds the local event index in events.py) ---
+def _event_from_result(ev: dict, city_nm: str) -> dict:
+    title   = ev.get("title", "")
+    venue   = ev.get("venue", {}).get("label", "") or ""
+    start   = ev.get("start", "")
 
-    lat, lon = coords
-    url = "https://api.predicthq.com/v1/events/"
-    headers = {
-        "Accept": "application/json",
-        "Authorization": f"Bearer {PREDICTHQ_TOKEN}"
+    return {
+        "valid": True,
+        "artist": title,
+        "venue": venue,
+        "city": city_nm,
+        "date": start,
+        "event": title,
+        "category": ev.get("category", "")
     }
-    params = {
+
+def _predicthq_bulk_params(coords: Tuple[float, float], radius_km: int, offset: int) -> dict:
+    lat, lon = coords
+    settings = get_settings()
+    today = date.today()
+    return {
         "within": f"{radius_km}km@{lat},{lon}",
         "country": "US",
-        "active": "true",
-        "limit": 1
+        "start.gte": (today - timedelta(days=2)).isoformat(),
+        "start.lte": (today + timedelta(days=settings.event_days_ahead)).isoformat(),
+        "sort": "start",
+        "limit": settings.event_page_size,
+        "offset": offset
     }
 
+def _predicthq_pager(location: str, coords: Tuple[float, float], radius_km: Optional[int],
+                     max_events: Optional[int], city: str):
+    """
+    The paging loop shared by the sync and async fetchers: yields the query
+    params for each page, is sent back that page's results, and returns the
+    collected events once a short page or max_events ends it.
+    """
+    settings = get_settings()
+    radius_km = radius_km or settings.event_radius_km
+    max_events = max_events or settings.event_ingest_max
+    city = city or city_name(location)
+    events = []
+    while len(events) < max_events:
+        page = yield _predicthq_bulk_params(coords, radius_km, len(events))
+        events += [_event_from_result(ev, city) for ev in page]
+        if len(page) < settings.event_page_size:
+            break
+    return events[:max_events]
+
+def fetch_predicthq_events(location: str, radius_km: Optional[int] = None,
+                           max_events: Optional[int] = None,
+                           coords: Optional[Tuple[float, float]] = None, city: str = "") -> List[dict]:
+    """
+    Page through upcoming PredictHQ events around a location (from two days
+    ago to EVENT_DAYS_AHEAD out), EVENT_RADIUS_KM and EVENT_INGEST_MAX
+    unless given. Returns event dicts (valid, artist, venue, city, date,
+    event, category); [] if the location is unknown.
+    HTTP failures raise so callers can tell "no events" from "no answer".
+    Callers that already resolved the coordinates or city name pass them.
+    """
+    coords = coords or geocode(location)
+    if not coords:
+        return []
+
+    settings = get_settings()
+    pager = _predicthq_pager(location, coords, radius_km, max_events, city)
     try:
-        resp = requests.get(url, headers=headers, params=params, timeout=5)
-        resp.raise_for_status()
-        results = resp.json().get("results", [])
-        if not results:
-            return {"valid": False}
-
-        ev = results[0]
-        title   = ev.get("title", "")
-        venue   = ev.get("venue", {}).get("label", "") or ""
-        start   = ev.get("start", "")
-        city_nm = location.split(",")[0]
-
-        return {
-            "valid": True,
-            "artist": title,
-            "venue": venue,
-            "city": city_nm,
-            "date": start,
-            "event": title
-        }
-    except Exception:
-        return {"valid": False}
+        params = next(pager)
+        while True:
+            resp = upstream.get("predicthq", settings.url_predicthq, headers=settings.predicthq_headers(), params=params)
+            resp.raise_for_status()
+            params = pager.send(resp.json().get("results", []))
+    except StopIteration as done:
+        return done.value
+
+async def fetch_predicthq_events_async(location: str, radius_km: Optional[int] = None,
+                                       max_events: Optional[int] = None,
+                                       coords: Optional[Tuple[float, float]] = None,
+                                       city: str = "") -> List[dict]:
+    coords = coords or await geocode_async(location)
+    if not coords:
+        return []
+
+    settings = get_settings()
+    pager = _predicthq_pager(location, coords, radius_km, max_events, city)
+    try:
+        params = next(pager)
+        while True:
+            resp = await upstream.get_async("predicthq", settings.url_predicthq, headers=settings.predicthq_headers(), params=params)
+            resp.raise_for_status()
+            params = pager.send(resp.json().get("results", []))
+    except StopIteration as done:
+        return done.value
+
+# --- Background refresh (see prefetch.py) ---
+async def refresh_context_async(locations, concurrency: int = 4) -> None:
+    """
+    Re-fetch weather and news for each location, bypassing and
+    overwriting the cache, so hot entries never expire on the request path.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def refresh(loc):
+        async with semaphore:
+            await asyncio.gather(
+                fetch_weather_async.refresh(loc),
+                fetch_news_rss_async.refresh(loc),
+                return_exceptions=True
+            )
+
+    await asyncio.gather(*(refresh(loc) for loc in locations))
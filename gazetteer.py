@@ -0,0 +1,117 @@
+import csv
+import difflib
+import os
+import re
+import sqlite3
+import threading
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from config import get_settings, lazy
+
+# --- Offline geocoding for US cities/states, in front of Nominatim ---
+
+# Bundled with the code, like data.CAPTIONS_DIR; only learned.sqlite3 lives under DATA_DIR
+PLACES_PATH = os.path.join(os.path.dirname(__file__), "data", "us_places.csv")
+
+_PUNCT = re.compile(r"[^\w\s]")
+_COUNTRY_SUFFIXES = ("united states of america", "united states", "usa", "us")
+
+def normalize(location: str) -> str:
+    """
+    "New York, NY, USA" -> "new york ny"; "St. Louis" -> "st louis".
+    """
+    text = " ".join(_PUNCT.sub("", location.lower()).split())
+    for suffix in _COUNTRY_SUFFIXES:
+        if text.endswith(" " + suffix):
+            text = text[: -len(suffix) - 1]
+            break
+    return text
+
+
+class Gazetteer:
+    """
+    Normalized-name index of the bundled US places file plus every location
+    Nominatim has resolved before (persisted in SQLite under DATA_DIR).
+    Lookups try an exact normalized match, then a fuzzy one over the bundled
+    names and the `fuzzy_learned` most recently learned ones, so a fuzzy
+    lookup costs the same however many places have been learned.
+    """
+
+    def __init__(self, path: str, db_path: str, fuzzy_cutoff: float = 0.88,
+                 fuzzy_learned: int = 2000):
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self._index: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+        self._load_places(path)
+        self._places = list(self._index)
+        self._learned: deque = deque(maxlen=fuzzy_learned)
+
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS learned (key TEXT PRIMARY KEY, lat REAL, lon REAL)"
+        )
+        self._conn.commit()
+        for key, lat, lon in self._conn.execute("SELECT key, lat, lon FROM learned ORDER BY rowid"):
+            if key not in self._index:
+                self._index[key] = (lat, lon)
+                self._learned.append(key)
+
+    def _load_places(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        states = {r["state"]: r["name"].replace(" State", "") for r in rows if r["kind"] == "state"}
+        # States first so city names and aliases win (e.g. "LA" = Los Angeles)
+        for row in sorted(rows, key=lambda r: r["kind"] != "state"):
+            coords = (float(row["lat"]), float(row["lon"]))
+            names = [row["name"]] + [a for a in row["aliases"].split(";") if a]
+            if row["kind"] == "state":
+                names += [row["state"], row["name"].replace(" State", "") + " state"]
+            else:
+                state_name = states.get(row["state"], "")
+                names += [f"{row['name']} {row['state']}", f"{row['name']} {state_name}"]
+            for name in names:
+                self._index[normalize(name)] = coords
+
+    def exact(self, location: str) -> Optional[Tuple[float, float]]:
+        """
+        Dictionary lookup only; cheap enough for the event loop.
+        """
+        return self._index.get(normalize(location))
+
+    def lookup(self, location: str) -> Optional[Tuple[float, float]]:
+        key = normalize(location)
+        if not key:
+            return None
+        coords = self._index.get(key)
+        if coords is not None or len(key) < 4:
+            return coords
+        with self._lock:
+            keys = self._places + list(self._learned)
+        match = difflib.get_close_matches(key, keys, n=1, cutoff=self.fuzzy_cutoff)
+        return self._index[match[0]] if match else None
+
+    def learn(self, location: str, coords: Tuple[float, float]) -> None:
+        """
+        Remember a geocoder answer so the next lookup is local.
+        """
+        key = normalize(location)
+        if not key or key in self._index:
+            return
+        with self._lock:
+            self._index[key] = coords
+            self._learned.append(key)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO learned VALUES (?, ?, ?)", (key, coords[0], coords[1])
+            )
+            self._conn.commit()
+
+
+def _load_gazetteer() -> Gazetteer:
+    settings = get_settings()
+    return Gazetteer(PLACES_PATH, settings.gazetteer_db_path, settings.gazetteer_fuzzy_cutoff)
+
+get_gazetteer = lazy(_load_gazetteer)
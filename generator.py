@@ -1,15 +1,15 @@
 import random
-import os
 from datetime import date
-from typing import Optional
-from templates import (
-    weather_caption_templates,
-    news_caption_templates,
-    opinion_caption_templates,
-    event_caption_templates,
-    fallback_event_captions
-)
-from fetchers import fetch_weather, fetch_news_rss, fetch_predicthq_event as fetch_event
+from typing import Optional, Union
+from templates import TEMPLATES
+from context import LocationContext
+from data import Corpus, get_corpus
+from events import find_event
+from metrics import timed
+
+# Prompt builders take a location string or a LocationContext; callers that
+# build several prompts for one location pass the same context
+Location = Union[str, LocationContext]
 
 def _relative_label(iso_dt: str) -> Optional[str]:
     if not iso_dt or len(iso_dt) < 10:
@@ -38,125 +38,148 @@ def _relative_label(iso_dt: str) -> Optional[str]:
         return d.strftime("next %A")
     return f"{d.strftime('%B')} {d.day}"
 
-def generate_baity_prompt(location: str, bio: str = "") -> str:
+def _plan_baity(bio: str):
     """
-    Occasionally we prefix with 'As a {bio}, ...' then carry on
-    with a weather/news/location/generic caption.
+    Make every random decision for a baity prompt up front, so the sync and
+    async variants only differ in how they fetch weather/news.
     """
-    from data import load_captions
-    reference_captions, _ = load_captions()
-
-    fallback = [
-        "Living my best life ✨",
-        "Ready for whatever comes next",
-        # …etc…
-    ]
-    if not reference_captions:
-        return random.choice(fallback)
+    corpus = get_corpus()
 
     # 20% chance we mention the bio
     personal = f"As a {bio}, " if bio and random.random() < 0.2 else ""
 
     bias = random.uniform(-5, 5)
 
-    # optional city‑specific captions
-    loc_caps = []
-    path = os.path.join(os.path.dirname(__file__), "data", "location_captions.txt")
-    if os.path.exists(path):
-        with open(path, encoding="utf-8") as f:
-            loc_caps = [l.strip() for l in f if l.strip()]
-
     choice = random.choices(
         ["weather", "news", "location", "generic"],
         weights=[15 + bias, 15 + bias, 30 + bias, 40 + bias],
         k=1
     )[0]
+    return corpus, personal, choice
+
+BAITY_FALLBACK = [
+    "Living my best life ✨",
+    "Ready for whatever comes next",
+    # …etc…
+]
+
+def _weather_caption(personal: str, cond: str, city: str) -> str:
+    return personal + TEMPLATES.pick("weather").render(weather_condition=cond, city_name=city)
+
+def _news_caption(personal: str, head: str) -> str:
+    return personal + TEMPLATES.pick("news").render(news_summary=head)
+
+def _finish_baity(corpus: Corpus, personal: str, choice: str, location: str) -> str:
+    # optional city‑specific captions
+    if choice == "location" and corpus.location:
+        lc = random.choice(corpus.location_templates)
+        return personal + lc.render(city_name=location, weather_condition="amazing",
+                                    news_summary="the latest happenings")
+
+    if choice == "generic":
+        if corpus.generic_baity:
+            return personal + random.choice(corpus.generic_baity)
+
+    # fallback to a generic reference caption
+    cap = random.choice(corpus.baity_templates)
+    return personal + cap.render(city_name=location, weather_condition="amazing",
+                                 news_summary="the latest happenings")
+
+@timed("prompt")
+def generate_baity_prompt(location: Location, bio: str = "") -> str:
+    """
+    Occasionally we prefix with 'As a {bio}, ...' then carry on
+    with a weather/news/location/generic caption.
+    """
+    ctx = LocationContext.of(location)
+    corpus, personal, choice = _plan_baity(bio)
+    if not corpus.baity:
+        return random.choice(BAITY_FALLBACK)
 
     if choice == "weather":
         try:
-            cond, city, _ = fetch_weather(location)
+            cond, city, _ = ctx.weather()
             if cond and city:
-                tpl = random.choice(weather_caption_templates)
-                return personal + tpl.format(weather_condition=cond, city_name=city)
-        except:
-            pass
+                return _weather_caption(personal, cond, city)
+        except Exception as e:
+            # Upstream down (or circuit open): use a reference caption instead
+            print(f"Weather lookup failed for {ctx.location}: {e}")
         choice = "reference"
 
     if choice == "news":
         try:
-            head = fetch_news_rss(location)
+            head = ctx.headline()
             if head:
-                tpl = random.choice(news_caption_templates)
-                return personal + tpl.format(news_summary=head)
-        except:
-            pass
+                return _news_caption(personal, head)
+        except Exception as e:
+            print(f"News lookup failed for {ctx.location}: {e}")
         choice = "reference"
 
-    if choice == "location" and loc_caps:
+    return _finish_baity(corpus, personal, choice, ctx.location)
+
+@timed("prompt")
+async def generate_baity_prompt_async(location: Location, bio: str = "") -> str:
+    ctx = LocationContext.of(location)
+    corpus, personal, choice = _plan_baity(bio)
+    if not corpus.baity:
+        return random.choice(BAITY_FALLBACK)
+
+    if choice == "weather":
         try:
-            lc = random.choice(loc_caps)
-            return personal + lc.replace("{city_name}", location)
-        except:
-            pass
+            cond, city, _ = await ctx.weather_async()
+            if cond and city:
+                return _weather_caption(personal, cond, city)
+        except Exception as e:
+            # Upstream down (or circuit open): use a reference caption instead
+            print(f"Weather lookup failed for {ctx.location}: {e}")
         choice = "reference"
 
-    if choice == "generic":
-        gens = [c for c in reference_captions if "{" not in c]
-        if gens:
-            return personal + random.choice(random.sample(gens, min(len(gens), 10)))
+    if choice == "news":
+        try:
+            head = await ctx.headline_async()
+            if head:
+                return _news_caption(personal, head)
+        except Exception as e:
+            print(f"News lookup failed for {ctx.location}: {e}")
+        choice = "reference"
 
-    # fallback to a generic reference caption
-    cap = random.choice(random.sample(reference_captions, min(len(reference_captions), 15)))
-    for ph, val in [
-        ("{city_name}", location),
-        ("{weather_condition}", "amazing"),
-        ("{news_summary}", "the latest happenings")
-    ]:
-        cap = cap.replace(ph, val)
-    return personal + cap
-
-def generate_opinion_prompt(base_prompt: str, location: str) -> str:
-    head = fetch_news_rss(location)
-    tpl = random.choice(opinion_caption_templates)
-    return tpl.format(base_prompt=base_prompt, news_summary=head)
+    return _finish_baity(corpus, personal, choice, ctx.location)
 
-def generate_event_prompt(base_prompt: str) -> str:
-    from data import US_CITIES
-    import time
-
-    start = time.time()
-    while time.time() - start < 5:
-        city = random.choice(US_CITIES)
-        ev = fetch_event(city)
-        lbl = _relative_label(ev.get("date", ""))
-        if ev.get("valid") and ev.get("artist") and lbl:
-            artist = ev["artist"]
-            venue = ev.get("venue", "")
-            city_n = ev.get("city", city)
-            if venue:
-                tpl = random.choice(event_caption_templates)
-                return tpl.format(
-                    base_prompt=base_prompt,
-                    artist=artist,
-                    venue=venue,
-                    city=city_n,
-                    date=lbl,
-                    event=ev.get("event", artist)
-                )
-            return f"{base_prompt}\n\n{artist} in {city_n} {lbl}"
-
-    return generate_baity_prompt(location)
-
-def generate_event_prompt_with_location(base_prompt: str, location: str) -> str:
-    ev = fetch_event(location)
+def _opinion_caption(base_prompt: str, head: str) -> str:
+    return TEMPLATES.pick("opinion").render(base_prompt=base_prompt, news_summary=head)
+
+@timed("prompt")
+def generate_opinion_prompt(base_prompt: str, location: Location) -> str:
+    ctx = LocationContext.of(location)
+    try:
+        head = ctx.headline()
+    except Exception as e:
+        print(f"News lookup failed for {ctx.location}: {e}")
+        head = f"No trending news in {ctx.location}."
+    return _opinion_caption(base_prompt, head)
+
+@timed("prompt")
+async def generate_opinion_prompt_async(base_prompt: str, location: Location) -> str:
+    ctx = LocationContext.of(location)
+    try:
+        head = await ctx.headline_async()
+    except Exception as e:
+        print(f"News lookup failed for {ctx.location}: {e}")
+        head = f"No trending news in {ctx.location}."
+    return _opinion_caption(base_prompt, head)
+
+def _event_caption(base_prompt: str, ev: dict, default_city: str) -> Optional[str]:
+    """
+    Turn a fetched event into a prompt, or None if it is unusable
+    (invalid, missing artist, or too far in the past).
+    """
     lbl = _relative_label(ev.get("date", ""))
     if ev.get("valid") and ev.get("artist") and lbl:
         artist = ev["artist"]
         venue = ev.get("venue", "")
-        city_n = ev.get("city", location.split(",")[0])
+        city_n = ev.get("city", default_city)
         if venue:
-            tpl = random.choice(event_caption_templates)
-            return tpl.format(
+            return TEMPLATES.pick("event").render(
                 base_prompt=base_prompt,
                 artist=artist,
                 venue=venue,
@@ -165,5 +188,37 @@ def generate_event_prompt_with_location(base_prompt: str, location: str) -> str:
                 event=ev.get("event", artist)
             )
         return f"{base_prompt}\n\n{artist} in {city_n} {lbl}"
+    return None
+
+@timed("prompt")
+def generate_event_prompt(base_prompt: str) -> str:
+    """
+    Event prompt for no particular location: the best upcoming event across
+    the major US cities, found within EVENT_SEARCH_BUDGET seconds.
+    """
+    from data import US_CITIES
 
-    return generate_baity_prompt(location)
+    hit = find_event(US_CITIES)
+    if hit:
+        city, ev = hit
+        prompt = _event_caption(base_prompt, ev, city)
+        if prompt:
+            return prompt
+
+    return generate_baity_prompt(random.choice(US_CITIES))
+
+@timed("prompt")
+def generate_event_prompt_with_location(base_prompt: str, location: Location) -> str:
+    ctx = LocationContext.of(location)
+    prompt = _event_caption(base_prompt, ctx.event(), ctx.display_city)
+    if prompt:
+        return prompt
+    return generate_baity_prompt(ctx)
+
+@timed("prompt")
+async def generate_event_prompt_with_location_async(base_prompt: str, location: Location) -> str:
+    ctx = LocationContext.of(location)
+    prompt = _event_caption(base_prompt, await ctx.event_async(), ctx.display_city)
+    if prompt:
+        return prompt
+    return await generate_baity_prompt_async(ctx)
@@ -0,0 +1,59 @@
+from typing import Optional
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import get_settings
+
+# --- Long-lived pooled clients shared by fetchers and the DeepSeek client ---
+_session: Optional[requests.Session] = None
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+def get_session() -> requests.Session:
+    """
+    Return the process-wide requests.Session (keep-alive, pooled per host).
+    """
+    global _session
+    if _session is None:
+        pool_size = get_settings().http_pool_size
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+    return _session
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    Return the process-wide httpx.AsyncClient. Created lazily so it binds
+    to the running event loop (uvicorn's) rather than import time.
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        settings = get_settings()
+        _async_client = httpx.AsyncClient(
+            timeout=settings.http_timeout,
+            limits=httpx.Limits(
+                max_connections=settings.http_pool_size,
+                max_keepalive_connections=settings.http_keepalive
+            ),
+            follow_redirects=True
+        )
+    return _async_client
+
+
+async def close_async_client() -> None:
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def close_session() -> None:
+    global _session
+    if _session is not None:
+        _session.close()
+        _session = None
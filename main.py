@@ -1,95 +1,255 @@
 # main.py
 
+import argparse
+import json
 import os
 import random
 import requests
-from config import URL_DEEPSEEK, HEADERS, OUTPUT_FILE_PATH
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Tuple
+
+from cache import MISS
+from config import get_settings
 from data import load_captions
+from dedupe import get_caption_index
+from deepseek import complete, get_response_cache, response_key
 from generator import generate_baity_prompt, generate_opinion_prompt, generate_event_prompt
-
-def main():
+from metrics import DUPLICATES
+from postprocess import clean_caption
+from sampler import draw
+from upstream import CircuitOpenError
+
+DEFAULT_LOCATIONS = ["New York", "California", "Texas", "Florida", "Illinois"]
+
+def generate_one(location: str, captions_baity: List[str], captions_opinion: List[str]) -> Tuple[str, Optional[str]]:
+    """
+    Generate a single caption of a random style for `location`.
+    Returns (style, caption) with caption None if DeepSeek failed, returned
+    nothing usable after cleanup, or only near-duplicates of captions
+    already generated.
+    """
+    style_choice = random.choice(["baity", "opinion", "event"])
+
+    if style_choice == "baity":
+        base_prompt = draw("baity", captions_baity)
+
+        dynamic_prompt = generate_baity_prompt(location)
+        system_content = (
+            "You are a creative assistant generating fresh, flirty, and inviting social media captions. "
+            "Keep the tone cheeky and engaging, but avoid using hashtags or tags. "
+            "Mention only one news or weather item if relevant—do not add extra topics."
+        )
+        user_message = f"{base_prompt}\n\n{dynamic_prompt}"
+
+    elif style_choice == "opinion":
+        base_prompt = draw("opinion", captions_opinion)
+
+        dynamic_prompt = generate_opinion_prompt(base_prompt, location)
+        system_content = (
+            "You are a creative assistant generating real, relatable, and location-based social media captions. "
+            "Reference only the single local news headline. Do not add extra or unrelated topics. "
+            "Keep it concise and avoid hashtags or tags."
+        )
+        user_message = dynamic_prompt
+
+    else:
+        base_prompt = draw("events", captions_opinion)
+
+        dynamic_prompt = generate_event_prompt(base_prompt)
+        system_content = (
+            "You are a creative assistant generating real, relatable, and location-based social media captions "
+            "focusing on a single local concert or festival event. Do not add unrelated topics. "
+            "Keep it concise and avoid hashtags or tags."
+        )
+        user_message = dynamic_prompt
+
+    payload = {
+        "model": "deepseek-chat",
+        "messages": [
+            {"role": "system", "content": system_content},
+            {"role": "user", "content": user_message}
+        ],
+        "stream": False,
+        "n": 1
+    }
+
+    # A cached completion may repeat itself, but not another caption
+    key = response_key(payload)
+    cached = get_response_cache().get(key)
+    if cached is not MISS:
+        if get_caption_index().check_and_add(cached, repeat_ok=True):
+            return style_choice, cached
+        get_response_cache().discard(key, cached)
+        DUPLICATES.inc(origin="cli")
+
+    # Ask again when DeepSeek repeats a caption already written out
+    for _ in range(1 + max(0, get_settings().dedupe_retries)):
+        try:
+            text = clean_caption(complete(payload))
+        except (requests.exceptions.RequestException, CircuitOpenError) as e:
+            print(f"DeepSeek API Error: {e}")
+            return style_choice, None
+        if not text:
+            return style_choice, None
+        if get_caption_index().check_and_add(text):
+            get_response_cache().add(key, [text])
+            return style_choice, text
+        DUPLICATES.inc(origin="cli")
+    print(f"Skipping near-duplicate {style_choice} caption: {text}")
+    return style_choice, None
+
+def drop_partial_line(path: str) -> None:
+    """
+    Cut an unterminated last line (crash mid-write) so appends start clean.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+def progress_path(path: str) -> str:
+    return path + ".progress"
+
+def save_progress(path: str, captions: int, size: int) -> None:
+    """
+    Record how many captions a plain-text output file holds and its size
+    after the last one. Captions may span lines, so resume reads this
+    rather than counting lines.
+    """
+    tmp = progress_path(path) + ".tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({"captions": captions, "bytes": size}, f)
+    os.replace(tmp, progress_path(path))
+
+def resume_text(path: str) -> int:
+    """
+    Captions recorded for a plain-text output file, cutting anything
+    written after the last recorded one. Files without a record (from
+    older runs) are counted by non-empty lines.
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        with open(progress_path(path), 'r', encoding='utf-8') as f:
+            progress = json.load(f)
+    except (OSError, ValueError):
+        drop_partial_line(path)
+        return count_existing(path, jsonl=False)
+    with open(path, 'rb+') as f:
+        f.truncate(progress["bytes"])
+    return progress["captions"]
+
+def count_existing(path: str, jsonl: bool) -> int:
+    """
+    Count captions already in a partial output file so a rerun can resume.
+    Unparseable JSONL records are not counted.
+    """
+    if not os.path.exists(path):
+        return 0
+    done = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if jsonl:
+                try:
+                    json.loads(line)
+                except ValueError:
+                    continue
+            done += 1
+    return done
+
+def main(count: int = 30, locations: Optional[List[str]] = None, concurrency: int = 1,
+         output_path: Optional[str] = None, jsonl: bool = False, resume: bool = False):
+    output_path = output_path or get_settings().output_path
     captions_baity, captions_opinion = load_captions()
 
     if not captions_baity or not captions_opinion:
         print("❌ Could not load captions. Please check your CSV/TXT files.")
         return
 
-    # Ensure the output directory exists
-    output_dir = os.path.dirname(OUTPUT_FILE_PATH)
-    os.makedirs(output_dir, exist_ok=True)
+    locations = locations or DEFAULT_LOCATIONS
 
-    used_baity = set()
-    used_opinion = set()
-    used_events = set()
-
-    with open(OUTPUT_FILE_PATH, 'w', encoding='utf-8') as output_file:
+    # Ensure the output directory exists
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    if not resume:
+        done = 0
+    elif jsonl:
+        drop_partial_line(output_path)
+        done = count_existing(output_path, jsonl)
+    else:
+        done = resume_text(output_path)
+    remaining = max(0, count - done)
+    if done:
+        print(f"Resuming: {done} captions already in {output_path}, {remaining} to go")
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as output_file:
+        if not jsonl:
+            save_progress(output_path, done, output_file.tell())
         print("\nGenerating a mix of 'baity', 'opinion', and 'event' captions:\n")
 
-        for _ in range(30):
-            style_choice = random.choice(["baity", "opinion", "event"])
-            location = random.choice(["New York", "California", "Texas", "Florida", "Illinois"])
-
-            if style_choice == "baity":
-                base_prompt = random.choice(captions_baity)
-                while base_prompt in used_baity:
-                    base_prompt = random.choice(captions_baity)
-                used_baity.add(base_prompt)
-
-                dynamic_prompt = generate_baity_prompt(location)
-                system_content = (
-                    "You are a creative assistant generating fresh, flirty, and inviting social media captions. "
-                    "Keep the tone cheeky and engaging, but avoid using hashtags or tags. "
-                    "Mention only one news or weather item if relevant—do not add extra topics."
-                )
-                user_message = f"{base_prompt}\n\n{dynamic_prompt}"
-
-            elif style_choice == "opinion":
-                base_prompt = random.choice(captions_opinion)
-                while base_prompt in used_opinion:
-                    base_prompt = random.choice(captions_opinion)
-                used_opinion.add(base_prompt)
-
-                dynamic_prompt = generate_opinion_prompt(base_prompt, location)
-                system_content = (
-                    "You are a creative assistant generating real, relatable, and location-based social media captions. "
-                    "Reference only the single local news headline. Do not add extra or unrelated topics. "
-                    "Keep it concise and avoid hashtags or tags."
-                )
-                user_message = dynamic_prompt
-
-            else:
-                base_prompt = random.choice(captions_opinion)
-                while base_prompt in used_events:
-                    base_prompt = random.choice(captions_opinion)
-                used_events.add(base_prompt)
-
-                dynamic_prompt = generate_event_prompt(base_prompt)
-                system_content = (
-                    "You are a creative assistant generating real, relatable, and location-based social media captions "
-                    "focusing on a single local concert or festival event. Do not add unrelated topics. "
-                    "Keep it concise and avoid hashtags or tags."
-                )
-                user_message = dynamic_prompt
-
-            payload = {
-                "model": "deepseek-chat",
-                "messages": [
-                    {"role": "system", "content": system_content},
-                    {"role": "user", "content": user_message}
-                ],
-                "stream": False,
-                "n": 1
-            }
-
-            response = requests.post(URL_DEEPSEEK, json=payload, headers=HEADERS)
-            if response.status_code == 200:
-                generated_text = response.json().get("choices", [])[0]['message']['content']
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            futures = {}
+            for _ in range(remaining):
+                location = random.choice(locations)
+                futures[pool.submit(generate_one, location, captions_baity, captions_opinion)] = location
+            # Stream each caption to disk as soon as it is ready
+            for future in as_completed(futures):
+                try:
+                    style_choice, generated_text = future.result()
+                except Exception as e:
+                    print(f"Generation failed: {e}")
+                    continue
+                if generated_text is None:
+                    continue
                 print(f"[{style_choice.upper()}] Generated Caption: {generated_text}")
-                output_file.write(f"{generated_text}\n")
-            else:
-                print(f"DeepSeek API Error {response.status_code}: {response.text}")
-
-    print(f"\n✅ All generated captions are saved to: {OUTPUT_FILE_PATH}")
+                if jsonl:
+                    record = {
+                        "caption": generated_text,
+                        "caption_type": style_choice,
+                        "location": futures[future]
+                    }
+                    output_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                else:
+                    output_file.write(f"{generated_text}\n")
+                output_file.flush()
+                done += 1
+                if not jsonl:
+                    save_progress(output_path, done, output_file.tell())
+
+    # Captions reach the index file in batches; write the last one out
+    get_caption_index().flush()
+    print(f"\n✅ All generated captions are saved to: {output_path}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a mix of baity, opinion and event captions.")
+    parser.add_argument("-n", "--count", type=int, default=30,
+                        help="total captions wanted in the output file (default: 30)")
+    parser.add_argument("-l", "--locations", nargs="+", default=DEFAULT_LOCATIONS,
+                        help="locations to pick from at random")
+    parser.add_argument("-c", "--concurrency", type=int, default=1,
+                        help="number of captions generated in parallel (default: 1)")
+    parser.add_argument("-o", "--output",
+                        help="output file (default: DATA_DIR/mixed_style_captions.txt); "
+                             "a .jsonl extension writes JSON lines")
+    parser.add_argument("--jsonl", action="store_true", help="write JSON lines regardless of extension")
+    parser.add_argument("--resume", action="store_true",
+                        help="append to an existing output file until it holds --count captions")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    args.output = args.output or get_settings().output_path
+    main(
+        count=args.count,
+        locations=args.locations,
+        concurrency=args.concurrency,
+        output_path=args.output,
+        jsonl=args.jsonl or args.output.endswith(".jsonl"),
+        resume=args.resume
+    )
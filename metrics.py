@@ -0,0 +1,210 @@
+import asyncio
+import functools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import tracing
+
+# --- In-process metrics rendered in the Prometheus text format ---
+
+# Latency buckets in seconds: cache hits (sub-ms) up to slow LLM calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """
+    Read at scrape time from a callback returning {label values: value}
+    (or a plain number when the gauge has no labels).
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read: Callable, labels: Iterable[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._read = read
+
+    def _samples(self) -> List[str]:
+        values = self._read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.label_names, k)} {_number(v)}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Iterable[str] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}   # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        series = self._series.get(self._key(labels))
+        return series[-1] if series else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for key, series in items:
+            bounds = [_number(b) for b in self.buckets] + ["+Inf"]
+            counts = series[:len(self.buckets)] + [series[-1]]
+            for bound, n in zip(bounds, counts):
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.label_names, key, le)} {n}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(series[-2])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {series[-1]}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self._metrics.values() for line in m.render()) + "\n"
+
+
+registry = Registry()
+
+# --- Pipeline metrics ---
+
+STAGE_SECONDS = registry.register(Histogram(
+    "caption_stage_seconds",
+    "Time spent per generation stage (sample, weather, news, geocode, events, prompt, deepseek, cleanup, dedupe)",
+    ("stage",)
+))
+REQUEST_SECONDS = registry.register(Histogram(
+    "caption_request_seconds", "End-to-end caption request latency", ("endpoint",)
+))
+CAPTIONS = registry.register(Counter(
+    "captions_total", "Captions served by type and origin (llm, cache, pool, fallback)", ("caption_type", "origin")
+))
+CACHE_LOOKUPS = registry.register(Counter(
+    "cache_lookups_total", "Context cache lookups by source and result", ("source", "result")
+))
+DUPLICATES = registry.register(Counter(
+    "caption_duplicates_total", "Near-duplicate captions rejected, by where they came from (llm, cache, pool, fallback, cli)",
+    ("origin",)
+))
+UPSTREAM_SECONDS = registry.register(Histogram(
+    "upstream_request_seconds", "Latency of single upstream HTTP attempts", ("service",)
+))
+UPSTREAM_ERRORS = registry.register(Counter(
+    "upstream_errors_total", "Failed upstream attempts by service and kind (status, transport, circuit_open)",
+    ("service", "kind")
+))
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    STAGE_SECONDS.observe(seconds, stage=name)
+    tracing.record("stages", stage=name, ms=round(seconds * 1000, 2))
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage into caption_stage_seconds and the active trace.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+def timed(name: str):
+    """
+    Decorator recording a plain or async function's duration as stage `name`.
+    """
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,316 @@
+import re
+from typing import Iterable, List
+
+# --- Caption post-processing shared by the API (whole, batched, streamed) and the CLI ---
+
+# Rules the system prompts ask for, enforced here
+MAX_LINES = 2
+MAX_EMOJI = 1
+
+_QUOTES = '"“”'
+# Characters str.splitlines() treats as line boundaries
+_LINE_BREAKS = "\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+# Emoji: a base pictograph plus its variation selector / skin tone, joined
+# by ZWJ into one cluster; a pair of regional indicators is one flag
+_BASE = "\u2300-\u23ff\u2600-\u27bf\u2b00-\u2bff\U0001f000-\U0001faff"
+_MODS = "\ufe0f\U0001f3fb-\U0001f3ff"
+_RI = "\U0001f1e6-\U0001f1ff"
+_ZWJ = "\u200d"
+_EMOJI = f"(?:[{_RI}]{{2}}|[{_BASE}])[{_MODS}]*(?:{_ZWJ}(?:[{_BASE}][{_MODS}]*)?)*"
+
+# Everything clean_caption drops, as one pass where the leftmost match wins:
+# parenthesised asides, hashtags (with the spaces before them), quotes, and
+# emoji clusters (kept or dropped by the callback, again with the spaces
+# before them). Only used for text that already holds _GAP. The lookahead
+# lets the scan skip plain characters without trying each branch.
+_TOKENS = re.compile(
+    rf'(?=[ \t(#{_QUOTES}{_BASE}])(?:\([^)]*\)|[ \t]*#\w+|[{_QUOTES}]|([ \t]*{_EMOJI}))'
+)
+_PARENS = re.compile(r"\([^)]*\)")
+_EMOJI_AT = re.compile(_EMOJI)
+# A pictograph followed by none of these (variation selector, ZWJ, skin
+# tone, regional indicator) is a cluster on its own
+_EXTENDERS = frozenset(
+    "\ufe0f" + _ZWJ + "".join(chr(c) for c in [*range(0x1f3fb, 0x1f400), *range(0x1f1e6, 0x1f200)])
+)
+_SPACES = re.compile(r"\s\s+")
+# Stands in for removed tokens until the emoji are dropped, so the text on
+# either side of a removed token never joins into one emoji cluster
+_GAP = "\x00"
+
+_BASE_RE = re.compile(f"[{_BASE}]")
+_MODS_RE = re.compile(f"[{_MODS}]")
+_RI_RE = re.compile(f"[{_RI}]")
+# StreamCleaner fast paths: a run of text it need not look at per character
+# (no whitespace, quotes or token starts), a whole chunk of such words
+# separated by single spaces or tabs, and the rest of a hashtag
+_PLAIN = rf"[^\s(#{_QUOTES}{_BASE}]+"
+_PLAIN_RUN = re.compile(rf"(\s+)|({_PLAIN})")
+_PLAIN_CHUNK = re.compile(rf"(\s*)((?:{_PLAIN}(?:[ \t]{_PLAIN})*)?)(\s*)")
+_WORD_RUN = re.compile(r"\w*")
+
+
+def clean_caption(text: str, max_lines: int = MAX_LINES, max_emoji: int = MAX_EMOJI) -> str:
+    """
+    Strip parenthesised asides, quotes and hashtags, keep the first
+    `max_emoji` emoji, collapse whitespace runs and keep the first
+    `max_lines` lines. Each rule is skipped when its character does not
+    occur, and ASCII captions skip the emoji scan.
+    """
+    # Only non-ASCII text can hold emoji; there removed tokens leave a _GAP
+    # until the emoji are counted
+    gap = "" if text.isascii() else _GAP
+    if gap and gap in text:
+        return _clean_tokens(text, max_lines, max_emoji)
+    # Hashtags before asides, as a left-to-right scan takes "#ta" from "#ta(x)g"
+    if "#" in text:
+        text = _drop_hashtags(text, gap)
+    if "(" in text:
+        text = _PARENS.sub(gap, text)
+    for quote in _QUOTES:
+        if quote in text:
+            text = text.replace(quote, gap)
+    if gap:
+        text = _drop_emoji(text, max_emoji).replace(_GAP, "")
+    return _lines(text, max_lines)
+
+def _drop_hashtags(text: str, gap: str) -> str:
+    # Each "#word" goes with the spaces and tabs before it; a lone "#" stays
+    parts = text.split("#")
+    out = [parts[0]]
+    for part in parts[1:]:
+        n = _WORD_RUN.match(part).end()
+        if n:
+            out[-1] = out[-1].rstrip(" \t")
+            out.append(gap + part[n:])
+        else:
+            out.append("#" + part)
+    return "".join(out)
+
+def _drop_emoji(text: str, keep: int) -> str:
+    # Emoji clusters after the first `keep` go with the spaces and tabs
+    # before them
+    out, pos, end, seen = [], 0, 0, 0
+    while (m := _BASE_RE.search(text, end)) is not None:
+        start = m.start()
+        end = start + 1
+        if text[end:end + 1] in _EXTENDERS:
+            end = _EMOJI_AT.match(text, start).end()
+        seen += 1
+        if seen > keep:
+            cut = start
+            while cut > pos and text[cut - 1] in " \t":
+                cut -= 1
+            out.append(text[pos:cut])
+            pos = end
+    if not out:
+        return text
+    out.append(text[pos:])
+    return "".join(out)
+
+def _clean_tokens(text: str, max_lines: int, max_emoji: int) -> str:
+    # The same rules as one regex pass, for text that already holds _GAP
+    seen = 0
+
+    def drop(m):
+        nonlocal seen
+        if m.group(1) is None:
+            return ""
+        seen += 1
+        return m.group(1) if seen <= max_emoji else ""
+
+    return _lines(_TOKENS.sub(drop, text), max_lines)
+
+def _lines(text: str, max_lines: int) -> str:
+    # Once whitespace runs are collapsed every line break stands alone, so
+    # splitlines() splits exactly at _LINE_BREAKS
+    text = _SPACES.sub(" ", text).strip()
+    return "\n".join(text.splitlines()[:max_lines])
+
+def clean_batch(texts: Iterable[str], **rules) -> List[str]:
+    """
+    Cleaned captions in order, without empties or exact repeats (e.g. the
+    n choices of one DeepSeek call).
+    """
+    return [c for c in dict.fromkeys(clean_caption(t, **rules) for t in texts) if c]
+
+
+class StreamCleaner:
+    """
+    Incremental clean_caption for streamed tokens: feed() chunks as they
+    arrive and get back the text that is safe to show. Parenthesised text
+    is held back until its ")" (and released at finish() if it never
+    closes, like the regex); a hashtag is held until it ends. Once the line
+    cap is hit `done` is set and the caller can stop reading upstream.
+    """
+
+    def __init__(self, max_lines: int = MAX_LINES, max_emoji: int = MAX_EMOJI):
+        self.max_lines = max_lines
+        self.max_emoji = max_emoji
+        self.done = False
+        self._paren = None     # text buffered since an unclosed "("
+        self._tag = None       # hashtag being read
+        self._emoji = None     # position in an emoji cluster: "R" (one flag half), "A", "Z" (after ZWJ)
+        self._drop_emoji = False
+        self._emojis = 0
+        self._ws = ""          # pending whitespace run
+        self._ws_kept = 0      # length of _ws from before the last dropped token
+        self._started = False  # leading whitespace is dropped
+        self._lines = 1
+
+    def feed(self, chunk: str) -> str:
+        out = []
+        if self._paren is None and self._tag is None and self._emoji is None and not self.done:
+            # Common case: words separated by single spaces, nothing to drop
+            m = _PLAIN_CHUNK.fullmatch(chunk)
+            if m is not None:
+                lead, words, trail = m.groups()
+                self._ws += lead
+                if words:
+                    self._plain_run(words, out)
+                    if self.done:
+                        return "".join(out)
+                self._ws += trail
+                return "".join(out)
+        i, n = 0, len(chunk)
+        while i < n and not self.done:
+            # Runs of plain text, whitespace, hashtag letters or
+            # parenthesised text are taken whole; anything else goes
+            # through the per-character state machine
+            if self._paren is not None:
+                j = chunk.find(")", i)
+                if j < 0:
+                    self._paren += chunk[i:]
+                    break
+                self._paren += chunk[i:j]
+                i = j
+            elif self._tag is not None:
+                j = _WORD_RUN.match(chunk, i).end()
+                if j > i:
+                    self._tag += chunk[i:j]
+                    i = j
+                    continue
+            elif self._emoji is None:
+                m = _PLAIN_RUN.match(chunk, i)
+                if m is not None:
+                    if m.lastindex == 1:
+                        self._ws += m.group(1)
+                    else:
+                        self._plain_run(m.group(2), out)
+                    i = m.end()
+                    continue
+            self._step(chunk[i], out)
+            i += 1
+        return "".join(out)
+
+    def finish(self) -> str:
+        out = []
+        if self._tag is not None:
+            self._end_tag(out)
+        if self._paren is not None:
+            # Never closed: the "(" and everything after it are plain text
+            buffered, self._paren = self._paren, None
+            self._plain("(", out)
+            for ch in buffered:
+                if self.done:
+                    break
+                self._step(ch, out, parens=False)
+            if self._tag is not None:
+                self._end_tag(out)
+        # trailing whitespace is dropped, as with .strip()
+        self._ws = ""
+        return "".join(out)
+
+    def _step(self, ch: str, out: list, parens: bool = True) -> None:
+        if self._paren is not None:
+            if ch == ")":
+                self._paren = None
+                self._ws_kept = len(self._ws)
+            else:
+                self._paren += ch
+            return
+        if self._tag is not None:
+            if ch.isalnum() or ch == "_":
+                self._tag += ch
+                return
+            self._end_tag(out)
+        if self._emoji is not None:
+            if self._continues_emoji(ch):
+                if self._drop_emoji:
+                    self._ws_kept = len(self._ws)
+                else:
+                    self._plain(ch, out)
+                return
+            self._emoji = None
+        if ch == "(" and parens:
+            self._paren = ""
+        elif ch == "#":
+            self._tag = "#"
+        elif _BASE_RE.match(ch):
+            self._emojis += 1
+            self._emoji = "R" if _RI_RE.match(ch) else "A"
+            self._drop_emoji = self._emojis > self.max_emoji
+            if self._drop_emoji:
+                self._trim_ws()
+            else:
+                self._plain(ch, out)
+        else:
+            self._plain(ch, out)
+
+    def _continues_emoji(self, ch: str) -> bool:
+        state = self._emoji
+        if state == "Z":
+            if _BASE_RE.match(ch):
+                self._emoji = "A"
+                return True
+            return ch == _ZWJ
+        if state == "R" and _RI_RE.match(ch):
+            self._emoji = "A"
+            return True
+        if _MODS_RE.match(ch):
+            self._emoji = "A"
+            return True
+        if ch == _ZWJ:
+            self._emoji = "Z"
+            return True
+        return False
+
+    def _end_tag(self, out: list) -> None:
+        tag, self._tag = self._tag, None
+        if len(tag) > 1:
+            self._trim_ws()
+        else:
+            self._plain("#", out)
+
+    def _trim_ws(self) -> None:
+        # A dropped hashtag/emoji takes the spaces and tabs right before it
+        # with it (not those before an earlier dropped token), like the regex
+        kept = self._ws_kept
+        self._ws = self._ws[:kept] + self._ws[kept:].rstrip(" \t")
+        self._ws_kept = len(self._ws)
+
+    def _plain(self, ch: str, out: list) -> None:
+        if ch in _QUOTES:
+            self._ws_kept = len(self._ws)
+            return
+        if ch.isspace():
+            self._ws += ch
+            return
+        self._plain_run(ch, out)
+
+    def _plain_run(self, text: str, out: list) -> None:
+        # `text` has no whitespace, quotes or token starts
+        if self._ws and self._started:
+            sep = " " if len(self._ws) >= 2 else self._ws
+            if sep in _LINE_BREAKS:
+                if self._lines >= self.max_lines:
+                    self.done = True
+                    return
+                self._lines += 1
+                sep = "\n"
+            out.append(sep)
+        self._ws = ""
+        self._ws_kept = 0
+        self._started = True
+        out.append(text)
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import threading
+import uuid
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from events import get_event_index
+from fetchers import refresh_context_async
+from shared import get_store, shared_enabled
+
+# --- Background warm-up of weather/news/event context for hot locations ---
+
+LEADER_KEY = "prefetch:leader"
+HOT_PREFIX = "prefetch:hot:"
+
+class Prefetcher:
+    """
+    Periodically refreshes context for a static list of locations plus the
+    top-N locations seen in requests, so request-path fetches hit the cache.
+    Also keeps the event index warm for `event_cities`, the candidates used
+    by location-less event discovery.
+    With shared state the workers share the caches, so only the worker
+    holding the prefetch lease refreshes, for every worker's top-N.
+    """
+
+    def __init__(self, static_locations: Iterable[str], interval: float = 300,
+                 top_n: int = 20, concurrency: int = 4, max_tracked: int = 10000,
+                 event_cities: Iterable[str] = ()):
+        self.static_locations = list(static_locations)
+        self.event_cities = list(event_cities)
+        self.interval = interval
+        self.top_n = top_n
+        self.concurrency = concurrency
+        self.max_tracked = max_tracked
+        self._seen: Counter = Counter()
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    def record(self, location: str) -> None:
+        """
+        Count a requested location toward the observed top-N.
+        """
+        loc = " ".join(location.split())
+        with self._lock:
+            self._seen[loc] += 1
+            # Keep the counter bounded: drop the long tail
+            if len(self._seen) > self.max_tracked:
+                self._seen = Counter(dict(self._seen.most_common(self.max_tracked // 2)))
+
+    def _observed(self) -> List[str]:
+        with self._lock:
+            return [loc for loc, _ in self._seen.most_common(self.top_n)]
+
+    def hot_locations(self, observed: Optional[List[str]] = None) -> List[str]:
+        if observed is None:
+            observed = self._observed()
+        # Static list first, then observed, without case-insensitive duplicates
+        hot, keys = [], set()
+        for loc in self.static_locations + observed:
+            if loc.lower() not in keys:
+                keys.add(loc.lower())
+                hot.append(loc)
+        return hot
+
+    def _elect(self) -> Tuple[bool, List[str]]:
+        """
+        Publish this worker's top-N and try for the lease. The leader gets
+        every live worker's published locations.
+        """
+        store = get_store()
+        ttl = 2 * self.interval
+        store.set(HOT_PREFIX + self._owner, self._observed(), ttl)
+        if not store.lease(LEADER_KEY, self._owner, ttl):
+            return False, []
+        return True, [loc for locs in store.get_prefix(HOT_PREFIX).values() for loc in locs]
+
+    async def refresh_once(self) -> None:
+        if shared_enabled():
+            leader, observed = await asyncio.to_thread(self._elect)
+            if not leader:
+                return
+            hot = self.hot_locations(observed)
+        else:
+            hot = self.hot_locations()
+        await refresh_context_async(hot, self.concurrency)
+        # Re-ingest events only where the index has gone stale
+        await get_event_index().ensure_async(hot + self.event_cities, self.concurrency)
+        if shared_enabled():
+            # Idle bags, buckets and pool keys would otherwise stay on disk
+            await asyncio.to_thread(get_store().purge_expired)
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.refresh_once()
+            except Exception as e:
+                print(f"Prefetch error: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,172 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+from collections import OrderedDict
+from typing import Any, Hashable, List, Optional, Sequence
+
+from config import lazy
+from shared import get_store, shared_enabled
+
+# --- No-repeat sampling for caption corpora ---
+
+class ShuffleBag:
+    """
+    Draws every item of a sequence once, in random order, before any repeat.
+    Each draw is O(1); memory is one index list the size of the corpus.
+    When the bag runs dry it reshuffles, avoiding an immediate back-to-back
+    repeat across the boundary.
+    """
+
+    def __init__(self, items: Sequence, rng: Optional[random.Random] = None):
+        self.items = items
+        self._rng = rng or random
+        self._order: List[int] = []
+        self._last: Optional[int] = None
+
+    def _refill(self) -> None:
+        order = list(range(len(self.items)))
+        self._rng.shuffle(order)
+        # We pop from the end, so keep the last-drawn index off that slot
+        if len(order) > 1 and order[-1] == self._last:
+            order[0], order[-1] = order[-1], order[0]
+        self._order = order
+
+    def draw(self) -> Any:
+        if not self.items:
+            raise IndexError("cannot draw from an empty corpus")
+        if not self._order:
+            self._refill()
+        idx = self._order.pop()
+        self._last = idx
+        return self.items[idx]
+
+    def remaining(self) -> int:
+        return len(self._order)
+
+
+class BagRegistry:
+    """
+    One ShuffleBag per (corpus name, scope key), e.g. per location or persona.
+    The number of bags is LRU-bounded, and a bag is rebuilt when the corpus
+    list it was built from is replaced (e.g. after a corpus hot-reload).
+    """
+
+    def __init__(self, max_bags: int = 1024):
+        self.max_bags = max_bags
+        self._bags: "OrderedDict[tuple, ShuffleBag]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def draw(self, name: str, items: Sequence, key: Hashable = None) -> Any:
+        bag_key = (name, key)
+        with self._lock:
+            bag = self._bags.get(bag_key)
+            if bag is None or bag.items is not items:
+                bag = ShuffleBag(items)
+                self._bags[bag_key] = bag
+            self._bags.move_to_end(bag_key)
+            while len(self._bags) > self.max_bags:
+                self._bags.popitem(last=False)
+            return bag.draw()
+
+    async def draw_async(self, name: str, items: Sequence, key: Hashable = None) -> Any:
+        return self.draw(name, items, key)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._bags.clear()
+
+
+class SharedBagRegistry:
+    """
+    BagRegistry whose bags live in the shared store, so every worker draws
+    from the same shuffled order and no caption repeats across workers
+    until the corpus is exhausted. The stored state is only a shuffle seed
+    and a cursor: each worker rebuilds (and caches) the order from the
+    seed, so a draw writes a few bytes however large the corpus. A bag is
+    reshuffled when the corpus fingerprint changes; bags idle for `ttl`
+    seconds are dropped.
+    """
+
+    def __init__(self, store, ttl: float = 7 * 24 * 3600, rng: Optional[random.Random] = None):
+        self.store = store
+        self.ttl = ttl
+        self._rng = rng or random
+        self._fingerprints: "OrderedDict[int, tuple]" = OrderedDict()   # id(items) -> (items, digest)
+        self._orders: "OrderedDict[tuple, List[int]]" = OrderedDict()   # (seed, size) -> order
+        self._lock = threading.Lock()
+
+    def _fingerprint(self, items: Sequence) -> str:
+        with self._lock:
+            known = self._fingerprints.get(id(items))
+            if known is not None and known[0] is items:
+                return known[1]
+        digest = hashlib.sha1("\n".join(map(str, items)).encode("utf-8")).hexdigest()
+        with self._lock:
+            # Holding the list keeps its id from being reused while cached
+            self._fingerprints[id(items)] = (items, digest)
+            while len(self._fingerprints) > 64:
+                self._fingerprints.popitem(last=False)
+        return digest
+
+    def _order(self, seed: int, size: int) -> List[int]:
+        key = (seed, size)
+        with self._lock:
+            order = self._orders.get(key)
+            if order is not None:
+                self._orders.move_to_end(key)
+                return order
+        order = list(range(size))
+        random.Random(seed).shuffle(order)
+        with self._lock:
+            self._orders[key] = order
+            while len(self._orders) > 64:
+                self._orders.popitem(last=False)
+        return order
+
+    def draw(self, name: str, items: Sequence, key: Hashable = None) -> Any:
+        if not items:
+            raise IndexError("cannot draw from an empty corpus")
+        fingerprint = self._fingerprint(items)
+        size = len(items)
+
+        def advance(state):
+            if not state or state["fp"] != fingerprint or state["pos"] >= size:
+                last = state.get("last") if state and state["fp"] == fingerprint else None
+                # Avoid a back-to-back repeat across the reshuffle
+                seed = self._rng.getrandbits(63)
+                while size > 1 and self._order(seed, size)[0] == last:
+                    seed = self._rng.getrandbits(63)
+                state = {"fp": fingerprint, "seed": seed, "pos": 0}
+            idx = self._order(state["seed"], size)[state["pos"]]
+            state["pos"] += 1
+            state["last"] = idx
+            return state, idx
+
+        store_key = "bag:" + json.dumps([name, key], default=str)
+        return items[self.store.update(store_key, advance, ttl=self.ttl)]
+
+    async def draw_async(self, name: str, items: Sequence, key: Hashable = None) -> Any:
+        return await asyncio.to_thread(self.draw, name, items, key)
+
+    def reset(self) -> None:
+        self.store.delete_prefix("bag:")
+
+
+def _make_bags():
+    return SharedBagRegistry(get_store()) if shared_enabled() else BagRegistry()
+
+get_bags = lazy(_make_bags)
+
+def draw(name: str, items: Sequence, key: Hashable = None) -> Any:
+    """
+    Non-repeating draw from the shared registry.
+    """
+    return get_bags().draw(name, items, key)
+
+async def draw_async(name: str, items: Sequence, key: Hashable = None) -> Any:
+    """
+    draw() for the event loop; shared bags are drawn in a worker thread.
+    """
+    return await get_bags().draw_async(name, items, key)
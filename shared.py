@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from config import get_settings, lazy
+
+# --- State shared by every uvicorn worker on a host (SQLite in WAL mode) ---
+
+class SQLiteStore:
+    """
+    Small key/value store in one SQLite file, safe to use from several
+    processes at once. Values are JSON. update() is the one atomic
+    primitive: a read-modify-write under BEGIN IMMEDIATE, which SQLite
+    serializes across processes (a Redis version would use WATCH/MULTI).
+    Any call may wait on another worker's write lock, so the async wrappers
+    around the store (bags, buckets, ready pool) run it in a worker thread.
+    """
+
+    def __init__(self, path: str, busy_timeout: float = 5.0):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        # Autocommit mode, so the explicit BEGIN IMMEDIATE below is honoured
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, expires REAL, value TEXT)"
+        )
+
+    def _read(self, key: str, now: float) -> Any:
+        row = self._conn.execute("SELECT expires, value FROM state WHERE key = ?", (key,)).fetchone()
+        if row is None or (row[0] is not None and row[0] <= now):
+            return None
+        return json.loads(row[1])
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            value = self._read(key, time.time())
+        return default if value is None else value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO state (key, expires, value) VALUES (?, ?, ?)",
+                (key, expires, json.dumps(value))
+            )
+
+    def get_prefix(self, prefix: str) -> Dict[str, Any]:
+        """
+        Unexpired values of every key starting with prefix.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, value FROM state WHERE substr(key, 1, ?) = ? AND (expires IS NULL OR expires > ?)",
+                (len(prefix), prefix, time.time())
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def lease(self, key: str, owner: str, ttl: float) -> bool:
+        """
+        Take or renew key for owner for ttl seconds. False while another
+        owner's lease on it is unexpired.
+        """
+        now = time.time()
+        with self._lock:
+            cur = self._conn.execute(
+                "INSERT INTO state (key, expires, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET expires = excluded.expires, value = excluded.value "
+                "WHERE state.value = excluded.value OR state.expires <= ?",
+                (key, now + ttl, json.dumps(owner), now)
+            )
+        return cur.rowcount == 1
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def delete_prefix(self, prefix: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE substr(key, 1, ?) = ?", (len(prefix), prefix))
+
+    def update(self, key: str, fn: Callable[[Any], Tuple[Any, Any]], ttl: Optional[float] = None) -> Any:
+        """
+        Atomically replace key's value with fn(current)[0] and return
+        fn(current)[1]. current is None when the key is absent or expired;
+        a new value of None deletes the key. ttl applies from this write.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                value, result = fn(self._read(key, now))
+                if value is None:
+                    self._conn.execute("DELETE FROM state WHERE key = ?", (key,))
+                else:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO state (key, expires, value) VALUES (?, ?, ?)",
+                        (key, None if ttl is None else now + ttl, json.dumps(value))
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return result
+
+    def purge_expired(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM state WHERE expires IS NOT NULL AND expires <= ?", (time.time(),))
+
+
+def shared_enabled() -> bool:
+    return get_settings().state_backend == "sqlite"
+
+def _open_store() -> SQLiteStore:
+    return SQLiteStore(get_settings().state_path)
+
+get_store = lazy(_open_store)
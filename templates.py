@@ -1,3 +1,7 @@
+import random
+import re
+from typing import Dict, List, Optional, Tuple
+
 weather_caption_templates = [
     "Hey, sunshine! ☀️ It's {weather_condition} in {city_name}. Perfect weather to make some unforgettable memories together 😉",
     "Is it {weather_condition} in {city_name}, or is it just you making it hot? 🔥 Let's turn up the heat!",
@@ -63,3 +67,170 @@ fallback_event_captions = [
     "{base_prompt}\n\nThe emptiness in my camera roll screams 'no recent concerts' 📱 Let's change that! #ConcertPhotoDump",
     "{base_prompt}\n\nTold my therapist I need live music to survive. She didn't disagree 💁‍♀️ #TherapeuticBeats"
 ]
+
+
+# --- Compiled registry: validated once at import, rendered with str.format ---
+
+# Placeholders each template list may use
+STYLE_FIELDS = {
+    "weather": {"weather_condition", "city_name"},
+    "news": {"news_summary"},
+    "opinion": {"base_prompt", "news_summary"},
+    "event": {"base_prompt", "artist", "venue", "city", "date", "event"},
+    "event_fallback": {"base_prompt"},
+}
+
+# Placeholders the corpus captions (data/*.txt, *.csv) may carry
+CORPUS_FIELDS = {"city_name", "weather_condition", "news_summary"}
+
+_PLACEHOLDER = re.compile(r"\{(\w*)\}")
+_HASHTAG = re.compile(r"[ \t]*#\w+")
+_FLIRTY = ("😉", "😘", "❤️", "💕", "🔥", "😍")
+
+
+def _tone(text: str) -> str:
+    """
+    Coarse tone tag: "flirty" for the winking/heart templates, "playful"
+    for any other emoji, "plain" otherwise.
+    """
+    if any(mark in text for mark in _FLIRTY):
+        return "flirty"
+    if any(ord(ch) >= 0x2600 for ch in text):
+        return "playful"
+    return "plain"
+
+
+class Template:
+    """
+    One caption template, parsed once. `render` is the bound str.format of
+    the normalized text: hashtags removed (the system prompts forbid them)
+    and any brace that is not an allowed placeholder escaped.
+    """
+
+    __slots__ = ("style", "index", "text", "fields", "tone", "has_hashtag", "problems", "uses", "_format")
+
+    def __init__(self, style: str, index: int, text: str, allowed: set, strict: bool = True):
+        self.style = style
+        self.index = index
+        self.text = text
+        self.has_hashtag = bool(_HASHTAG.search(text))
+        self.tone = _tone(text)
+        self.problems: List[str] = []
+        self.uses = 0
+
+        body = _HASHTAG.sub("", text).rstrip() if strict else text
+        parts, fields, pos = [], [], 0
+        for m in _PLACEHOLDER.finditer(body):
+            parts.append(self._literal(body[pos:m.start()]))
+            name = m.group(1)
+            if name in allowed:
+                parts.append(m.group(0))
+                fields.append(name)
+            else:
+                parts.append(self._literal(m.group(0)))
+                self.problems.append(f"unknown placeholder {m.group(0)}")
+            pos = m.end()
+        parts.append(self._literal(body[pos:]))
+        if strict and not body.strip():
+            self.problems.append("empty after removing hashtags")
+        if not strict:
+            # Corpus captions keep stray braces and unknown names verbatim
+            self.problems = []
+        self.fields = frozenset(fields)
+        self._format = "".join(parts).format
+
+    def _literal(self, chunk: str) -> str:
+        if "{" in chunk or "}" in chunk:
+            if not _PLACEHOLDER.fullmatch(chunk):
+                self.problems.append("unbalanced brace")
+            chunk = chunk.replace("{", "{{").replace("}", "}}")
+        return chunk
+
+    def render(self, **values) -> str:
+        self.uses += 1
+        return self._format(**values)
+
+    def describe(self) -> dict:
+        return {
+            "style": self.style,
+            "index": self.index,
+            "tone": self.tone,
+            "has_hashtag": self.has_hashtag,
+            "fields": sorted(self.fields),
+            "uses": self.uses,
+            "problems": self.problems,
+            "text": self.text,
+        }
+
+
+def compile_caption(text: str, fields=CORPUS_FIELDS) -> Template:
+    """
+    Lenient compile for corpus captions: only known placeholders are
+    substituted, everything else (hashtags, stray braces) is kept as is.
+    """
+    return Template("corpus", 0, text, fields, strict=False)
+
+
+class TemplateRegistry:
+    """
+    Templates indexed by (style, tone, has_hashtag) with None as a wildcard,
+    so selection is one dict lookup plus random.choice. Invalid templates are
+    kept out of the index and listed by report().
+    """
+
+    def __init__(self, groups: Dict[str, List[str]], fields: Dict[str, set] = STYLE_FIELDS):
+        self.templates: List[Template] = []
+        self._index: Dict[Tuple, List[Template]] = {}
+        for style, texts in groups.items():
+            seen = set()
+            for i, text in enumerate(texts):
+                tpl = Template(style, i, text, fields.get(style, set()))
+                if text in seen:
+                    tpl.problems.append("duplicate")
+                seen.add(text)
+                self.templates.append(tpl)
+                if tpl.problems:
+                    continue
+                for tone in (None, tpl.tone):
+                    for tagged in (None, tpl.has_hashtag):
+                        self._index.setdefault((style, tone, tagged), []).append(tpl)
+
+    def pick(self, style: str, tone: Optional[str] = None, has_hashtag: Optional[bool] = None) -> Template:
+        """
+        Random valid template of `style`; tone/has_hashtag narrow the choice
+        and are ignored if nothing matches them.
+        """
+        choices = (self._index.get((style, tone, has_hashtag))
+                   or self._index.get((style, None, None)))
+        if not choices:
+            raise KeyError(f"No valid {style} templates")
+        return random.choice(choices)
+
+    def invalid(self) -> List[Template]:
+        return [t for t in self.templates if t.problems]
+
+    def report(self) -> dict:
+        """
+        Invalid templates, and valid ones never rendered since startup.
+        """
+        by_style: Dict[str, int] = {}
+        for (style, tone, tagged), items in self._index.items():
+            if tone is None and tagged is None:
+                by_style[style] = len(items)
+        return {
+            "valid": by_style,
+            "invalid": [t.describe() for t in self.invalid()],
+            "unused": [t.describe() for t in self.templates if not t.problems and t.uses == 0],
+        }
+
+
+TEMPLATES = TemplateRegistry({
+    "weather": weather_caption_templates,
+    "news": news_caption_templates,
+    "opinion": opinion_caption_templates,
+    "event": event_caption_templates,
+    "event_fallback": fallback_event_captions,
+})
+
+for _tpl in TEMPLATES.invalid():
+    print(f"Warning: skipping {_tpl.style} template #{_tpl.index}: {', '.join(_tpl.problems)}")
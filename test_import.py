@@ -1,5 +1,6 @@
-from config import URL_DEEPSEEK, HEADERS, OUTPUT_FILE_PATH
+from config import get_settings
 
-print("URL_DEEPSEEK:", URL_DEEPSEEK)
-print("HEADERS:", HEADERS)
-print("OUTPUT_FILE_PATH:", OUTPUT_FILE_PATH)
+settings = get_settings()
+print("URL_DEEPSEEK:", settings.url_deepseek)
+print("HEADERS:", settings.deepseek_headers())
+print("output_path:", settings.output_path)
@@ -0,0 +1,111 @@
+import cProfile
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+# --- Opt-in per-request traces (and sampled cProfile captures) ---
+
+class Trace:
+    """
+    Collects what happened while serving one request: stage timings, cache
+    lookups, upstream attempts and free-form fields (style, token usage).
+    Tasks spawned by the request share it through the context variable.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.fields: dict = {}
+        self.entries: dict = {}
+
+    def add(self, kind: str, **fields) -> None:
+        self.entries.setdefault(kind, []).append(fields)
+
+    def to_dict(self) -> dict:
+        upstream = self.entries.get("upstream", [])
+        return {
+            **self.fields,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "stages": self.entries.get("stages", []),
+            "cache": self.entries.get("cache", []),
+            "upstream": upstream,
+            "retries": sum(1 for call in upstream if call.get("attempt", 0) > 0),
+        }
+
+
+_current: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+
+@contextmanager
+def capture():
+    """
+    Make a fresh Trace active for the enclosed code and yield it.
+    """
+    trace = Trace()
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+def current() -> Optional[Trace]:
+    return _current.get()
+
+def record(kind: str, **fields) -> None:
+    """
+    Append to the active trace; a no-op (one context lookup) otherwise.
+    """
+    trace = _current.get()
+    if trace is not None:
+        trace.add(kind, **fields)
+
+def note(**fields) -> None:
+    trace = _current.get()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+class Profile:
+    """
+    cProfile capture dumped to `directory` as a .prof file (open with
+    pstats or snakeviz), deleting the oldest captures beyond `max_files`.
+    Only one runs at a time; while another is active this one is skipped
+    and `path` stays None. On an event loop the profile also sees other
+    requests' coroutines interleaved with this one.
+    """
+
+    _active = threading.Lock()
+
+    def __init__(self, directory: str, max_files: int = 50):
+        self.directory = directory
+        self.max_files = max_files
+        self.path: Optional[str] = None
+        self._profiler: Optional[cProfile.Profile] = None
+
+    def __enter__(self):
+        if Profile._active.acquire(blocking=False):
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        Profile._active.release()
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}.prof"
+        self.path = os.path.join(self.directory, name)
+        self._profiler.dump_stats(self.path)
+        self._rotate()
+
+    def _rotate(self) -> None:
+        # Names start with the timestamp, so they sort oldest first
+        dumps = sorted(n for n in os.listdir(self.directory) if n.endswith(".prof"))
+        for name in dumps[:max(0, len(dumps) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass  # another worker rotated it first
@@ -0,0 +1,294 @@
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+import requests
+
+from config import get_settings
+from http_client import get_session, get_async_client
+from metrics import UPSTREAM_ERRORS, UPSTREAM_SECONDS
+from shared import get_store, shared_enabled
+import tracing
+
+# --- Shared upstream calls: timeouts, retries, circuit breakers, hedging ---
+
+# Statuses worth retrying (and counted against the breaker)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised without calling upstream while a service's breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failed calls and fast-fails for
+    `reset_after` seconds; then lets one trial call through (half-open),
+    closing again on success. A trial that never reports back (e.g. a
+    cancelled hedge) is written off after another `reset_after`.
+    """
+
+    def __init__(self, name: str, threshold: Optional[int] = None, reset_after: Optional[float] = None):
+        settings = get_settings()
+        self.name = name
+        self.threshold = settings.breaker_threshold if threshold is None else threshold
+        self.reset_after = settings.breaker_reset if reset_after is None else reset_after
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def check(self) -> None:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            now = time.monotonic()
+            if state == "half-open" and (self._trial_at is None or now - self._trial_at >= self.reset_after):
+                self._trial_at = now
+                return
+        UPSTREAM_ERRORS.inc(service=self.name, kind="circuit_open")
+        raise CircuitOpenError(f"{self.name} circuit is open")
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_at = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_at = None
+            if self._failures >= self.threshold or self._opened_at is not None:
+                self._opened_at = time.monotonic()
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+def breaker(service: str) -> CircuitBreaker:
+    found = breakers.get(service)
+    if found is None:
+        # setdefault is atomic, so racing first callers share one breaker
+        found = breakers.setdefault(service, CircuitBreaker(service))
+    return found
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second with bursts of up to `burst`. take()
+    reserves a token and returns how long the caller must wait for it
+    (0 while tokens are available), so waiters are served in arrival order.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token even if it goes negative: later callers queue behind
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def take_async(self) -> float:
+        return self.take()
+
+    def acquire(self) -> None:
+        delay = self.take()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self) -> None:
+        delay = await self.take_async()
+        if delay:
+            await asyncio.sleep(delay)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose level lives in the shared store, so `rate` is the
+    limit for all workers together rather than for each one.
+    """
+
+    def __init__(self, store, name: str, rate: float, burst: int):
+        super().__init__(rate, burst)
+        self.store = store
+        self.key = f"bucket:{name}"
+
+    def take(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+
+        def reserve(state):
+            now = time.time()
+            tokens, updated = state if state else (float(self.burst), now)
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate) - 1
+            return [tokens, now], (0.0 if tokens >= 0 else -tokens / self.rate)
+
+        # Idle buckets refill completely after burst/rate seconds anyway
+        return self.store.update(self.key, reserve, ttl=self.burst / self.rate + 60)
+
+    async def take_async(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        return await asyncio.to_thread(self.take)
+
+
+buckets: Dict[str, TokenBucket] = {}
+
+def bucket(service: str) -> TokenBucket:
+    found = buckets.get(service)
+    if found is None:
+        rate, burst = get_settings().rate_limits.get(service, (0, 0))
+        if shared_enabled():
+            found = SharedTokenBucket(get_store(), service, rate, burst)
+        else:
+            found = TokenBucket(rate, burst)
+        found = buckets.setdefault(service, found)
+    return found
+
+def _backoff(attempt: int) -> float:
+    # Full jitter: uniform over [0, base * 2^attempt], capped
+    settings = get_settings()
+    return random.uniform(0, min(settings.backoff_max, settings.backoff_base * 2 ** attempt))
+
+def _observe(service: str, start: float, attempt: int, status: Optional[int] = None,
+             error: Optional[str] = None) -> None:
+    elapsed = time.perf_counter() - start
+    UPSTREAM_SECONDS.observe(elapsed, service=service)
+    if error:
+        UPSTREAM_ERRORS.inc(service=service, kind=error)
+    tracing.record("upstream", service=service, attempt=attempt, status=status,
+                   error=error, ms=round(elapsed * 1000, 2))
+
+def _retryable(exc: Exception) -> bool:
+    return isinstance(exc, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        httpx.TransportError,
+    ))
+
+def request(service: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Blocking request through the shared session, paced by the service's
+    token bucket (every attempt counts). Retries transport errors
+    and RETRY_STATUSES with jittered backoff. Responses are returned as-is
+    (including a still-failing one after the last retry) so callers keep
+    using raise_for_status()/status_code; transport errors re-raise.
+    """
+    cb = breaker(service)
+    cb.check()
+    settings = get_settings()
+    kwargs.setdefault("timeout", settings.timeouts[service])
+    retries = settings.retries[service]
+    for attempt in range(retries + 1):
+        bucket(service).acquire()
+        start = time.perf_counter()
+        try:
+            resp = get_session().request(method, url, **kwargs)
+        except Exception as e:
+            _observe(service, start, attempt, error="transport")
+            if not _retryable(e):
+                raise
+            if attempt == retries:
+                cb.record_failure()
+                raise
+            time.sleep(_backoff(attempt))
+            continue
+        _observe(service, start, attempt, resp.status_code, "status" if resp.status_code >= 400 else None)
+        if resp.status_code not in RETRY_STATUSES:
+            cb.record_success()
+            return resp
+        if attempt == retries:
+            cb.record_failure()
+            return resp
+        time.sleep(_backoff(attempt))
+
+async def request_async(service: str, method: str, url: str, **kwargs) -> httpx.Response:
+    cb = breaker(service)
+    cb.check()
+    settings = get_settings()
+    kwargs.setdefault("timeout", settings.timeouts[service])
+    retries = settings.retries[service]
+    for attempt in range(retries + 1):
+        await bucket(service).acquire_async()
+        start = time.perf_counter()
+        try:
+            resp = await get_async_client().request(method, url, **kwargs)
+        except Exception as e:
+            _observe(service, start, attempt, error="transport")
+            if not _retryable(e):
+                raise
+            if attempt == retries:
+                cb.record_failure()
+                raise
+            await asyncio.sleep(_backoff(attempt))
+            continue
+        _observe(service, start, attempt, resp.status_code, "status" if resp.status_code >= 400 else None)
+        if resp.status_code not in RETRY_STATUSES:
+            cb.record_success()
+            return resp
+        if attempt == retries:
+            cb.record_failure()
+            return resp
+        await asyncio.sleep(_backoff(attempt))
+
+def get(service: str, url: str, **kwargs) -> requests.Response:
+    return request(service, "GET", url, **kwargs)
+
+def post(service: str, url: str, **kwargs) -> requests.Response:
+    return request(service, "POST", url, **kwargs)
+
+async def get_async(service: str, url: str, **kwargs) -> httpx.Response:
+    return await request_async(service, "GET", url, **kwargs)
+
+async def post_async(service: str, url: str, hedge_delay: float = 0, **kwargs) -> httpx.Response:
+    """
+    Like request_async(POST). With hedge_delay > 0, a second identical
+    request is started if the first has not answered after hedge_delay
+    seconds; whichever succeeds first wins and the other is cancelled.
+    """
+    if hedge_delay <= 0:
+        return await request_async(service, "POST", url, **kwargs)
+
+    first = asyncio.ensure_future(request_async(service, "POST", url, **kwargs))
+    done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+    if done:
+        return first.result()
+
+    second = asyncio.ensure_future(request_async(service, "POST", url, **kwargs))
+    pending = {first, second}
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()